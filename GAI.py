@@ -2,18 +2,24 @@ import sublime
 import sublime_plugin
 import os
 import json
-import http.client
+import time
 import threading
-from time import sleep
 from abc import abstractmethod
-import logging
 
-# Create a logger
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-
-# Create a formatter and attach it to the handlers
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+try:
+    from .gai_core import (build_request, get_ledger, ledger_paths, logger,
+                           pack_context, project_index, remove_logs,
+                           rename_identifiers, request_completion,
+                           request_edit, request_profiler, setup_logs,
+                           usage_ledger)
+    from .gai_core import configurator as base_configurator
+except (ImportError, SystemError):
+    from gai_core import (build_request, get_ledger, ledger_paths, logger,
+                          pack_context, project_index, remove_logs,
+                          rename_identifiers, request_completion,
+                          request_edit, request_profiler, setup_logs,
+                          usage_ledger)
+    from gai_core import configurator as base_configurator
 
 
 class code_generator(sublime_plugin.TextCommand):
@@ -70,6 +76,9 @@ class code_generator(sublime_plugin.TextCommand):
         if thread.running:
             message = "Thinking, one moment... ({}/{}s)".format(
                 seconds, max_time)
+            if thread.config_handle.routing_decision:
+                message += " - routed to {}".format(
+                    thread.config_handle.routing_decision)
             sublime.status_message(message)
             sublime.set_timeout(lambda:
                                 self.manage_thread(thread,
@@ -77,6 +86,10 @@ class code_generator(sublime_plugin.TextCommand):
                                                    seconds + 1), 1000)
             return
 
+        if thread.error:
+            sublime.status_message("GAI request failed: " + thread.error)
+            return
+
         if not thread.result:
             sublime.status_message(
                 "Something is wrong, did not receive response - aborting")
@@ -88,161 +101,13 @@ class code_generator(sublime_plugin.TextCommand):
         })
 
 
-class configurator():
-
-    def __init__(self, configurations, section_name, base_obj):
-        self.base_obj = base_obj
-        self.__section_cursor__ = section_name
-
-        self.cancelled = False  
-
-        self.source_config__meta__ = configurations.get("__meta__", {})
-
-        # Read Sublime Text configuration object
-        self.source_config = {}
-        self.source_config["oai"] = configurations.get("oai", {})
-        self.source_config[section_name] = configurations.get(section_name, {})
-
-        # print("Source configuration")
-        # print(self.source_config)
-
-        # Read the section configuration
-        self.__running_config__ = {}
-        self.__running_config__["alternates"] = configurations.get(
-            "alternates", {})
-        self.__configuration__completed__ = False
-        self.__construct__running__config__()
-
-    def __construct__running__config__(self):
-
-        def populate_dict(input_dict, target_dict):
-
-            def merge_value(input_val, target_val, key):
-                # Consider merging different value types , e.g. string personas based on key
-
-                target_prio_str_keys = [ 
-                    "prompt"
-                ]
-                target_prio_str_keys = self.source_config__meta__.get("target_prio_str_keys", target_prio_str_keys)
-
-                input_prio_str_keys = self.source_config__meta__.get("target_prio_str_keys", [])
-
-                input_prio_keys = self.source_config__meta__.get("target_prio_str_keys", [])
-
-                if key in target_prio_str_keys:
-                    return target_val + "\n\n" + input_val
-                elif key in input_prio_str_keys:
-                    return input_val + "\n\n" + target_val
-                elif key in input_prio_keys:
-                    return input_val
-                else:
-                    return target_val
-
-
-            def merge_dict_value(lhs, rhs, k):
-                if isinstance(lhs,dict):
-                    dict_val = lhs
-                    val = rhs
-                else:
-                    dict_val = rhs
-                    val = lhs
-
-                merged = dict_val
-                merged[k] = val
-
-                return merged
-
-
-            def merge_dict(k):
-                # Return value if key ony exists in the target dictionary
-                if k in target_dict.keys() and k not in input_dict.keys():
-                    return target_dict[k]
-
-                # Return value if key only exists in the input dictionary 
-                if k in input_dict.keys() and k not in target_dict.keys():
-                    return input_dict[k]
-
-                # Merge value according to rules if key exists in both and is a value for both
-                if k in input_dict.keys() and k in target_dict.keys():
-                    if not isinstance(input_dict[k],dict) and not isinstance(target_dict[k], dict):
-                        return merge_value(input_dict[k], target_dict[k], k)
-
-                if k in input_dict.keys() and k in target_dict.keys():
-                    if isinstance(input_dict[k], dict) and isinstance(target_dict[k],dict):
-                        # Merge dictionaries if key exists in both an is a dictionary
-                        return populate_dict(input_dict[k], target_dict[k])
-                    elif isinstance(input_dict[k], dict) or isinstance(target_dict[k], dict):
-                        # Merge dictionary with value if key exists in both
-                        return merge_dict_value(input_dict[k],target_dict[k], k)
-
-
-            keys = set(list(target_dict.keys()) + list(input_dict.keys()))
-            return {k: merge_dict(k) for k in keys}
-
-
-        # Construct oai configuration from global and section
-        default_oai = self.source_config["oai"]
-        self.__running_config__ = populate_dict(
-            default_oai, self.__running_config__)
-
-        section_config = self.source_config[self.__section_cursor__]
-        self.__running_config__ = populate_dict(
-            section_config, self.__running_config__)
-
-        def replace_config(config_name):
-            if config_name:
-                alternates = self.__running_config__["alternates"]
-                config_override = alternates[config_name]
-                self.__running_config__ = populate_dict(
-                    self.__running_config__, config_override)
-
-        def on_done(index):
-            if index == -1:
-                self.cancelled = True  
-            else:
-                configs_list = ["__default__"]
-                configs_list += list(alternates.keys())
-                selected_config = configs_list[index]
-                if selected_config != "__default__":
-                    replace_config(selected_config)
-            self.__configuration__completed__ = True
-
-        default_alternate = self.__running_config__[
-            "alternates"].get("default", None)
-        if default_alternate is not None:
-            replace_config(default_alternate)
-            self.__configuration__completed__ = True
-        else:
-            alternates = self.__running_config__["alternates"]
-            self.base_obj.view.window().show_quick_panel(
-                ["default"] + list(alternates.keys()), on_select=on_done)
-
-        # print("Before selection configuration \n\n")
-        # print(self.__running_config__)
-
-    def ready_wait(self, sleep_duration=0.2):
-        while not self.__configuration__completed__:
-            sleep(sleep_duration)
-
-    def is_cancelled(self):
-        self.ready_wait()
-        return self.cancelled
-
-    def get_prompt(self, default=""):
-        self.ready_wait()
-        return self.__running_config__.get("prompt", default)
-
-    def get_persona(self, default="You are a helpful AI Assistant"):
-        self.ready_wait()
-        return self.__running_config__.get("persona", default)
-
-    def get_model(self, default="gpt-4"):
-        self.ready_wait()
-        return self.__running_config__.get("model", default)
+class configurator(base_configurator):
+    """
+    Configurator asking the user to pick the alternate in a quick panel.
+    """
 
-    def get(self, key, default=None):
-        self.ready_wait()
-        return self.__running_config__.get(key, default)
+    def select_alternate(self, items, on_done):
+        self.base_obj.view.window().show_quick_panel(items, on_select=on_done)
 
 
 class base_code_generator(code_generator):
@@ -250,22 +115,55 @@ class base_code_generator(code_generator):
     A base class for generating code. This class should be inherited by
     specific code generator classes.
     """
+    profiler = None
+    # Whether Python selections are renamed locally when "rename_engine" is
+    # set, instead of being rewritten by the model
+    renames_identifiers = False
+    # Whether the changes are requested as a patch when "edit_format" is set
+    edits_with_patches = False
+
     def base_execute(self, edit):
 
+        if not profile_next_request.is_set():
+            self.profiler = None
+            return self.execute_pipeline(edit)
+
+        profile_next_request.clear()
+        self.profiler = request_profiler()
+        self.profiler.start()
+        try:
+            self.profiler.profile("UI thread: base_execute",
+                                  self.execute_pipeline, edit)
+        except Exception:
+            # No request thread is left to write the report
+            write_profile(self.profiler)
+            raise
+
+    def execute_pipeline(self, edit):
+
         self.validate_setup()
 
         configurations = sublime.load_settings('gai.sublime-settings')
         section_name = self.code_generator_settings()
 
-        config_handle = configurator(configurations, section_name, self)
-
         selected_region = self.view.sel()[0]
         code_region = self.view.substr(selected_region)
 
+        config_handle = configurator(configurations, section_name, self,
+                                     code_region)
+
         data_handle = self.create_data(config_handle, code_region)
 
+        ledger_path = os.path.join(sublime.cache_path(), "GAI", "usage.jsonl")
+        rename_source = None
+        if self.renames_identifiers and self.view.match_selector(
+                selected_region.begin(), "source.python"):
+            rename_source = code_region
+
         codex_thread = async_code_generator(selected_region, config_handle,
-                                            data_handle)
+                                            data_handle, ledger_path,
+                                            rename_source, self.profiler,
+                                            self.edits_with_patches)
         codex_thread.start()
         self.manage_thread(codex_thread, config_handle.__running_config__.get(
                            "max_seconds", 60))
@@ -273,39 +171,36 @@ class base_code_generator(code_generator):
     def create_data(self, config_handle, code_region):
 
         data_container = {"text": None, "data": None}
+        retrieval_scope = self.retrieval_scope()
 
         def async_prepare():
-            code_prompt = config_handle.get_prompt()
-            code_instruction = self.additional_instruction()
-            user_code_content = "{} {} {}".format(
-                code_prompt, code_instruction, code_region)
-
-            data = {
-                'messages': [{
-                    'role': 'system',
-                    'content': config_handle.get_persona(),
-                }, {
-                    'role': 'user',
-                    'content': user_code_content
-                }],
-                'model': config_handle.get_model(),
-                'max_tokens': config_handle.get('max_tokens', 100),
-                'temperature': config_handle.get('temperature', 0),
-                'top_p': config_handle.get('top_p', 1)
-            }
-
-            text = ""
-            if config_handle.get('keep_prompt_text', False):
-                text = code_region
+            instruction = self.additional_instruction()
+            context = self.retrieve_context(config_handle, code_region,
+                                            instruction, retrieval_scope)
+            edit_format = config_handle.get("edit_format", None) \
+                if self.edits_with_patches else None
+            data, text = build_request(config_handle, code_region,
+                                       instruction, context, edit_format)
 
             data_container["data"] = data
             data_container["text"] = text
+            data_container["source"] = code_region
+            if edit_format is not None:
+                # Full rewrite request, used when the patch does not apply
+                data_container["fallback"] = build_request(
+                    config_handle, code_region, instruction, context)[0]
 
             log_level = config_handle.get("log_level", "requests")
             if log_level in ["requests", "all"]:
                 logger.info("Request Data: %s", json.dumps(data, indent=4))
 
-        prepthread = threading.Thread(target=async_prepare)
+        prepare = async_prepare
+        profiler = self.profiler
+        if profiler is not None:
+            def prepare():
+                profiler.profile("Worker thread: create_data", async_prepare)
+
+        prepthread = threading.Thread(target=prepare)
         prepthread.start()
 
         def await_result(field):
@@ -314,6 +209,45 @@ class base_code_generator(code_generator):
 
         return await_result
 
+    def retrieval_scope(self):
+        """
+        Returns the project folders, the file name and the (first, last)
+        lines of the selection, read from the view on the UI thread.
+        """
+        window = self.view.window()
+        folders = window.folders() if window is not None else []
+
+        selected_region = self.view.sel()[0]
+        lines = (self.view.rowcol(selected_region.begin())[0] + 1,
+                 self.view.rowcol(selected_region.end())[0] + 1)
+        return folders, self.view.file_name(), lines
+
+    def retrieve_context(self, config_handle, code_region, instruction,
+                         retrieval_scope):
+        """
+        Returns the snippets of the project relevant to the selection packed
+        within the token budget, when retrieval is enabled and the project
+        index is built.
+        """
+        retrieval = config_handle.get("retrieval", None) or {}
+        folders, file_name, lines = retrieval_scope
+        if not retrieval.get("enabled", False) or not folders:
+            return ""
+
+        index = get_project_index(folders, retrieval)
+        if not index.ready:
+            logger.info("Project index is still building, no context added")
+            return ""
+
+        results, query_seconds = index.search(
+            instruction + " " + code_region, retrieval.get("top_k", 5),
+            file_name, lines)
+        sublime.status_message(
+            "GAI retrieved {} snippets in {:.1f}ms ({} files indexed in "
+            "{:.2f}s)".format(len(results), query_seconds * 1000,
+                              index.files, index.build_seconds))
+        return pack_context(results, retrieval.get("budget_tokens", 1500))
+
     @ abstractmethod
     def code_generator_settings(self):
         pass
@@ -351,6 +285,7 @@ class complete_code_generator(base_code_generator):
 
 
 class whiten_code_generator(base_code_generator):
+    renames_identifiers = True
 
     def run(self, edit):
         super().base_execute(edit)
@@ -360,6 +295,7 @@ class whiten_code_generator(base_code_generator):
 
 
 class edit_code_generator(base_code_generator):
+    edits_with_patches = True
 
     def input(self, args):
         return instruction_input_handler()
@@ -383,121 +319,203 @@ class instruction_input_handler(sublime_plugin.TextInputHandler):
         return "E.g.: 'translate to java' or 'add documentation'"
 
 
+project_indexes = {}
+project_indexes_lock = threading.Lock()
+
+
+def get_project_index(folders, retrieval):
+    """
+    Returns the index of the project folders, building it in the background
+    the first time it is requested.
+    """
+    include = retrieval.get("include", ["*"])
+    exclude = retrieval.get("exclude", [".git", "node_modules", "__pycache__"])
+    max_file_kb = retrieval.get("max_file_kb", 256)
+
+    # Changing the indexed files settings builds a new index
+    key = (tuple(sorted(folders)), tuple(include), tuple(exclude),
+           max_file_kb)
+    with project_indexes_lock:
+        index = project_indexes.get(key)
+        if index is not None:
+            return index
+
+        index = project_index(folders, include, exclude, max_file_kb * 1024)
+        project_indexes[key] = index
+
+    def build():
+        index.build()
+        sublime.status_message("GAI indexed {} files in {:.2f}s".format(
+            index.files, index.build_seconds))
+
+    threading.Thread(target=build).start()
+    return index
+
+
+class gai_index_listener(sublime_plugin.EventListener):
+    """
+    Keeps the project indexes up to date when files are saved.
+    """
+
+    def on_post_save_async(self, view):
+        file_name = view.file_name()
+        if file_name is None:
+            return
+
+        with project_indexes_lock:
+            indexes = list(project_indexes.values())
+        for index in indexes:
+            index.update_path(file_name)
+
+
+profile_next_request = threading.Event()
+
+
+def write_profile(profiler):
+    """
+    Stops the profiler, writes its report to the cache folder and opens it in
+    a new view.
+    """
+    profiler.stop()
+
+    profile_dir = os.path.join(sublime.cache_path(), "GAI")
+    profile_path = os.path.join(profile_dir, time.strftime(
+        "profile-%Y%m%d-%H%M%S.txt"))
+    try:
+        os.makedirs(profile_dir, exist_ok=True)
+        with open(profile_path, "w", encoding="utf-8") as profile_io:
+            profile_io.write(profiler.report())
+    except (IOError, OSError):
+        logger.exception("Could not write the request profile")
+        return
+    logger.info("Wrote the request profile to %s", profile_path)
+
+    sublime.set_timeout(
+        lambda: sublime.active_window().open_file(profile_path), 0)
+
+
 class async_code_generator(threading.Thread):
     running = False
     result = None
+    error = None
 
-    def __init__(self, region, config_handle, data_handle):
+    def __init__(self, region, config_handle, data_handle, ledger_path=None,
+                 rename_source=None, profiler=None,
+                 edits_with_patches=False):
         super().__init__()
 
         self.region = region
         self.config_handle = config_handle
         self.data_handle = data_handle
+        self.ledger_path = ledger_path
+        self.rename_source = rename_source
+        self.profiler = profiler
+        self.edits_with_patches = edits_with_patches
 
         self.logging_file_handler = None
 
     def run(self):
         self.running = True
-        self.setup_logs()
-        if not self.config_handle.is_cancelled():
-            self.result = self.get_code_generator_response()
-        else:
-            self.result = []
-
-        if self.logging_file_handler is not None:
-            self.logging_file_handler.close()
-            logger.removeHandler(self.logging_file_handler)
-        
-        self.running = False
-
-    def setup_logs(self):
-
-        def stream_handler_added():
-            return any(isinstance(handler, logging.StreamHandler) 
-                for handler in logger.handlers)
-
-        def same(cur_handler, lfile):
-            cur_file = os.path.abspath(cur_handler.baseFilename)
-            return cur_file == os.path.abspath(lfile)
-
-        def file_handler_added(logfile):
-            return any(isinstance(handler, logging.FileHandler) 
-                and same(handler, logfile) for handler in logger.handlers)
-
-        # Add a stream handler if not already defined given configuration
-        if self.config_handle.get("log_level", None) is not None:
-            if not stream_handler_added():
-                stream_handler = logging.StreamHandler()
-                stream_handler.setFormatter(formatter)
-                logger.addHandler(stream_handler)
-
-        # Add a file handler if not already present given configuration
-        file_log_io = self.config_handle.get("log_file", None)
-        
-        if file_log_io is not None and not file_handler_added(file_log_io):
-            file_handler = logging.FileHandler(file_log_io)
-            self.logging_file_handler = file_handler
-            file_handler.setFormatter(formatter)
-            logger.addHandler(file_handler)
+        self.logging_file_handler = setup_logs(self.config_handle)
+        try:
+            if self.config_handle.is_cancelled():
+                self.result = []
+            elif self.profiler is not None:
+                self.result = self.profiler.profile(
+                    "Worker thread: async_code_generator.run",
+                    self.get_code_generator_response)
+            else:
+                self.result = self.get_code_generator_response()
+        except Exception as e:
+            self.error = str(e)
+            logger.exception("Request failed")
+        finally:
+            if self.profiler is not None:
+                write_profile(self.profiler)
+            remove_logs(self.logging_file_handler)
+            self.running = False
 
     def get_code_generator_response(self):
 
-        self.endpoint = self.config_handle.get("open_ai_endpoint")
-        self.apibase = self.config_handle.get("open_ai_base")
-        self.apikey = self.config_handle.get("open_ai_key")
         self.data = self.data_handle("data")
         self.text_replace = self.data_handle("text")
+        ledger = get_ledger(self.config_handle, self.ledger_path)
+
+        if self.rename_source is not None and \
+                self.config_handle.get("rename_engine", None):
+            try:
+                ai_code = rename_identifiers(self.config_handle,
+                                             self.rename_source, ledger,
+                                             sublime.status_message)
+                sublime.status_message("Identifiers renamed locally")
+                return ai_code
+            except ValueError as e:
+                logger.warning("Falling back to rewriting the code: %s", e)
+
+        edit_format = self.config_handle.get("edit_format", None) \
+            if self.edits_with_patches else None
+        if edit_format is not None:
+            ai_code, usage = request_edit(
+                self.config_handle, self.data, self.data_handle("fallback"),
+                self.data_handle("source"), edit_format, ledger,
+                sublime.status_message)
+        else:
+            ai_code, usage = request_completion(
+                self.config_handle, self.data, ledger, sublime.status_message)
+        sublime.status_message("Tokens used: " + str(usage['total_tokens']))
+        return ai_code
 
-        connection = http.client.HTTPSConnection(
-            self.apibase)
+    def get_max_seconds(self):
+        return self.config_handle.get("max_seconds", 60)
 
-        headers = {
-            'api-key': self.apikey,
-            'Authorization': 'Bearer {}'.format(self.apikey),
-            'Content-Type': 'application/json'
-        }
-        data = json.dumps(self.data)
 
+# Settings sections of the commands, which may each set their usage ledger
+command_sections = ["command_completions", "command_generate",
+                    "command_write", "command_whiten", "command_edits"]
 
-        log_level = self.config_handle.get("log_level", None)
 
-        # print("Configuration before execution of request \n\n")
-        # print(self.config_handle.__running_config__)
+class replace_text_command(sublime_plugin.TextCommand):
 
-        if log_level in ["requests", "all"]:
-            logger.info("Request Headers: %s", json.dumps(headers, indent=4))
-            logger.info("Request Data: %s", json.dumps(self.data, indent=4))
+    def run(self, edit, region, text):
+        region = sublime.Region(*region)
+        self.view.replace(edit, region, text)
 
-        connection.request('POST', self.endpoint, body=data, headers=headers)
-        response = connection.getresponse()
 
-        if log_level in ["all"]:
-            logger.info("Response Status: %s", response.status)
-            logger.info("Response Headers: %s", json.dumps(dict(response.headers), indent=4))
+class gai_usage_report_command(sublime_plugin.WindowCommand):
+    """
+    Opens a new view with the token usage and cost aggregated per day,
+    section and model from every usage ledger of the settings.
+    """
 
-        response_dict = json.loads(response.read().decode())
+    def run(self):
+        configurations = sublime.load_settings('gai.sublime-settings')
+        paths = ledger_paths(
+            configurations, command_sections,
+            os.path.join(sublime.cache_path(), "GAI", "usage.jsonl"))
 
-        if log_level in ["all"]:
-            logger.info("Response Data: %s", json.dumps(response_dict, indent=4))
+        if not paths:
+            sublime.status_message("Usage ledger is disabled")
+            return
 
-        if response_dict.get('error', None):
-            raise ValueError(response_dict['error'])
-        else:
-            choice = response_dict.get('choices', [{}])[0]
-            ai_code = choice['message']['content']
-            usage = response_dict['usage']['total_tokens']
-            sublime.status_message("Tokens used: " + str(usage))
-        return ai_code
+        report = "\n".join(usage_ledger.for_path(ledger_path).report()
+                           for ledger_path in paths)
 
-    def get_max_seconds(self):
-        return self.config_handle.get("max_seconds", 60)
+        report_view = self.window.new_file()
+        report_view.set_name("GAI Usage")
+        report_view.set_scratch(True)
+        report_view.run_command('append', {'characters': report})
 
 
-class replace_text_command(sublime_plugin.TextCommand):
+class gai_profile_next_request_command(sublime_plugin.ApplicationCommand):
+    """
+    Profiles the next request with cProfile and tracemalloc, from the command
+    on the UI thread to the response on the worker thread, and opens the
+    report once the request is done.
+    """
 
-    def run(self, edit, region, text):
-        region = sublime.Region(*region)
-        self.view.replace(edit, region, text)
+    def run(self):
+        profile_next_request.set()
+        sublime.status_message("GAI will profile the next request")
 
 
 class edit_gai_plugin_settings_command(sublime_plugin.ApplicationCommand):
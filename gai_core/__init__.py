@@ -0,0 +1,16 @@
+"""
+Sublime Text independent core of GAI: configuration merge, prompt building,
+transport, endpoint balancing, usage ledger, routing, local renaming,
+project retrieval, patch edits, batch processing and request profiling.
+"""
+from .balancer import balancer, endpoint_balancer
+from .config import configurator, load_settings
+from .ledger import usage_ledger
+from .logs import formatter, logger, remove_logs, setup_logs
+from .patch import apply_patch, request_edit
+from .profiling import request_profiler
+from .prompt import build_request, estimate_tokens
+from .rename import rename_identifiers
+from .retrieval import bm25_index, pack_context, project_index
+from .routing import alternate_router, router
+from .transport import get_ledger, ledger_paths, request_completion
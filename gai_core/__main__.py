@@ -0,0 +1,77 @@
+"""
+Runs a GAI command over a directory tree without Sublime Text.
+
+Example, from the package directory:
+
+    python -m gai_core --settings gai.sublime-settings \
+        --settings ../User/gai.sublime-settings \
+        --command command_whiten --include "*.py" --exclude ".git" src
+"""
+import os
+import sys
+import argparse
+
+from .batch import run_batch
+from .config import load_settings
+from .logs import remove_logs, setup_logs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m gai_core",
+        description="Run a GAI command over the files of a directory tree.")
+    parser.add_argument("root", help="Directory to process.")
+    parser.add_argument("--settings", action="append", required=True,
+                        help="gai.sublime-settings file, repeat to override "
+                             "with later files (e.g. the User settings).")
+    parser.add_argument("--command", required=True,
+                        help="Command section, e.g. command_whiten.")
+    parser.add_argument("--instruction", default="",
+                        help="Instruction, as given to the edit command.")
+    parser.add_argument("--alternate", default=None,
+                        help="Alternate configuration to use.")
+    parser.add_argument("--include", action="append", default=None,
+                        help="Glob of the files to process, repeatable "
+                             "(default: all files).")
+    parser.add_argument("--exclude", action="append", default=[],
+                        help="Glob of the files or directories to skip, "
+                             "repeatable.")
+    parser.add_argument("--output", default=None,
+                        help="Directory to write the results to, by default "
+                             "files are rewritten in place.")
+    parser.add_argument("--jobs", type=int, default=4,
+                        help="Number of files processed in parallel.")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Maximum number of requests per minute.")
+    parser.add_argument("--checkpoint", default=None,
+                        help="Checkpoint file used to resume an interrupted "
+                             "run (default: ROOT/.gai-checkpoint.json).")
+    args = parser.parse_args(argv)
+
+    configurations = load_settings(*args.settings)
+    checkpoint_path = args.checkpoint or os.path.join(
+        args.root, ".gai-checkpoint.json")
+    instruction = "Instruction: " + args.instruction if args.instruction \
+        else ""
+
+    file_handler = setup_logs(configurations.get("oai", {}))
+    try:
+        done, skipped, failed = run_batch(
+            configurations, args.command, args.root,
+            include=args.include or ["*"], exclude=args.exclude,
+            output=args.output, jobs=args.jobs, rate=args.rate,
+            checkpoint_path=checkpoint_path, instruction=instruction,
+            alternate=args.alternate)
+    except KeyboardInterrupt:
+        print("Interrupted, run again to resume from " + checkpoint_path)
+        return 130
+    finally:
+        remove_logs(file_handler)
+
+    print("{} done, {} skipped, {} failed".format(
+        len(done), len(skipped), len(failed)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+import time
+import threading
+
+
+class endpoint_balancer():
+    """
+    Distributes requests over several endpoints of the same deployment and
+    tracks their health passively from the outcome of the requests.
+
+    Each endpoint has a circuit breaker which opens after failure_threshold
+    consecutive failures or timeouts. An open endpoint receives no requests
+    until reset_seconds have passed, after which a single probe request is
+    let through: success closes the circuit, failure opens it again.
+
+    Methods
+    -------
+    acquire(endpoints, balancing):
+
+        Chooses an endpoint for a request.
+
+    release(endpoint, latency, failed, balancing):
+
+        Records the outcome of a request sent to an endpoint.
+
+    stats():
+
+        Returns the statistics of every endpoint.
+    """
+
+    alpha = 0.3
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    @staticmethod
+    def normalize(endpoint):
+        """
+        Endpoints are either a host or a dictionary overriding the
+        open_ai_base, open_ai_endpoint and open_ai_key of the section.
+        """
+        if isinstance(endpoint, dict):
+            return endpoint
+        return {"open_ai_base": endpoint}
+
+    def __state__(self, base):
+        return self.endpoints.setdefault(base, {
+            "state": "closed", "outstanding": 0, "latency": None,
+            "failures": 0, "opened_at": None, "requests": 0, "errors": 0})
+
+    def __available__(self, state, now, reset_seconds):
+        if state["state"] == "closed":
+            return True
+        if state["state"] == "open":
+            return now - state["opened_at"] >= reset_seconds
+        # A probe is already in flight
+        return False
+
+    def acquire(self, endpoints, balancing=None):
+        """
+        Chooses among the endpoints whose circuit is closed, or ready to be
+        probed, the one with the least outstanding requests or the lowest
+        recent latency depending on the "strategy" of the balancing
+        configuration. Raises ValueError if every circuit is open.
+        """
+        balancing = balancing or {}
+        strategy = balancing.get("strategy", "least_outstanding")
+        reset_seconds = balancing.get("reset_seconds", 30)
+
+        endpoints = [self.normalize(endpoint) for endpoint in endpoints]
+        now = time.time()
+
+        def load(indexed):
+            index, state = indexed
+            if strategy == "latency":
+                # Endpoints without history are tried first
+                latency = state["latency"] if state["latency"] is not None \
+                    else 0.0
+                return (latency, state["outstanding"], index)
+            return (state["outstanding"], state["latency"] or 0.0, index)
+
+        with self.lock:
+            candidates = [
+                (index, self.__state__(endpoint["open_ai_base"]))
+                for index, endpoint in enumerate(endpoints)]
+            candidates = [(index, state) for index, state in candidates
+                          if self.__available__(state, now, reset_seconds)]
+
+            if not candidates:
+                raise ValueError(
+                    "All endpoints are unavailable, circuits are open")
+
+            index, state = min(candidates, key=load)
+            if state["state"] == "open":
+                state["state"] = "half_open"
+            state["outstanding"] += 1
+            state["requests"] += 1
+
+        return endpoints[index]
+
+    def release(self, endpoint, latency=None, failed=False, balancing=None):
+        balancing = balancing or {}
+        failure_threshold = balancing.get("failure_threshold", 3)
+
+        with self.lock:
+            state = self.__state__(endpoint["open_ai_base"])
+            state["outstanding"] = max(state["outstanding"] - 1, 0)
+
+            if failed:
+                state["errors"] += 1
+                state["failures"] += 1
+                if state["state"] == "half_open" or \
+                        state["failures"] >= failure_threshold:
+                    state["state"] = "open"
+                    state["opened_at"] = time.time()
+                return
+
+            state["failures"] = 0
+            state["state"] = "closed"
+            if latency is not None:
+                state["latency"] = latency if state["latency"] is None \
+                    else self.alpha * latency + \
+                    (1 - self.alpha) * state["latency"]
+
+    def stats(self):
+        with self.lock:
+            return dict((base, dict(state))
+                        for base, state in self.endpoints.items())
+
+
+balancer = endpoint_balancer()
@@ -0,0 +1,224 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .config import configurator
+from .logs import logger
+from .patch import request_edit
+from .paths import find_files
+from .prompt import build_request
+from .rename import rename_identifiers
+from .transport import get_ledger, request_completion
+
+# Sections whose Python sources are renamed locally when "rename_engine" is set
+RENAME_SECTIONS = ("command_whiten",)
+# Sections whose changes are requested as a patch when "edit_format" is set
+EDIT_SECTIONS = ("command_edits",)
+
+
+class rate_limiter():
+    """
+    Spaces requests evenly so that at most requests_per_minute are sent
+    across all worker threads.
+    """
+
+    def __init__(self, requests_per_minute=None):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute \
+            else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class checkpoint():
+    """
+    Records the files already processed, by relative path, with the hash of
+    their input and output so that an interrupted run can be resumed without
+    requesting them again.
+
+    The checkpoint also records the run it belongs to (section, instruction,
+    alternate, output and a digest of the settings). A checkpoint of a
+    different run is reset instead of skipping files it never processed.
+    """
+
+    def __init__(self, path, run=None):
+        self.path = path
+        self.run = run or {}
+        self.lock = threading.Lock()
+        self.files = {}
+
+        if path is not None and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as checkpoint_io:
+                stored = json.load(checkpoint_io)
+            if stored.get("run") == self.run:
+                self.files = stored.get("files", {})
+            else:
+                logger.info("Checkpoint %s is of another run, starting over",
+                            path)
+
+    @staticmethod
+    def digest(text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def run_of(cls, configurations, section_name, instruction, alternate,
+               output):
+        """
+        Describes a run, with a digest of the settings as they change what
+        the requests return.
+        """
+        return {"section": section_name, "instruction": instruction,
+                "alternate": alternate,
+                "output": os.path.abspath(output) if output else None,
+                "settings": cls.digest(json.dumps(configurations,
+                                                  sort_keys=True))}
+
+    def is_done(self, relpath, text):
+        """
+        Returns whether the file was processed, either left untouched with an
+        output written elsewhere or already rewritten in place.
+        """
+        entry = self.files.get(relpath)
+        if entry is None:
+            return False
+        return self.digest(text) in (entry["input"], entry["output"])
+
+    def mark_done(self, relpath, input_text, output_text):
+        with self.lock:
+            self.files[relpath] = {"input": self.digest(input_text),
+                                   "output": self.digest(output_text)}
+            if self.path is not None:
+                atomic_write(self.path, json.dumps(
+                    {"run": self.run, "files": self.files}, indent=1))
+
+
+def atomic_write(path, text):
+    """
+    Writes a file through a temporary file in the same directory which is
+    then renamed, so that readers never see a partially written file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    handle, temp_path = tempfile.mkstemp(dir=directory, prefix=".gai-")
+    try:
+        with os.fdopen(handle, "w", encoding="utf-8") as temp_io:
+            temp_io.write(text)
+        os.replace(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def process_text(configurations, section_name, text, instruction="",
+                 alternate=None, python_source=False):
+    """
+    Runs a command section over a text the same way the plugin does over a
+    selection and returns the replacement text.
+    """
+    config_handle = configurator(configurations, section_name,
+                                 request_text=text, alternate=alternate)
+    edit_format = config_handle.get("edit_format", None) \
+        if section_name in EDIT_SECTIONS else None
+    data, text_replace = build_request(config_handle, text, instruction,
+                                       edit_format=edit_format)
+    ledger = get_ledger(config_handle)
+
+    if python_source and section_name in RENAME_SECTIONS and \
+            config_handle.get("rename_engine", None):
+        try:
+            return text_replace + rename_identifiers(config_handle, text,
+                                                     ledger)
+        except ValueError as e:
+            logger.warning("Falling back to rewriting the code: %s", e)
+
+    if edit_format is not None:
+        fallback_data = build_request(config_handle, text, instruction)[0]
+        result, usage = request_edit(config_handle, data, fallback_data, text,
+                                     edit_format, ledger)
+    else:
+        result, usage = request_completion(config_handle, data, ledger)
+    return text_replace + result
+
+
+def run_batch(configurations, section_name, root, include=("*",),
+              exclude=(), output=None, jobs=4, rate=None,
+              checkpoint_path=None, instruction="", alternate=None,
+              report=print):
+    """
+    Runs a command section over every matching file of a directory tree.
+
+    Files are processed in parallel by at most jobs threads and at most rate
+    requests per minute. Results are written atomically, in place or under
+    the output directory, and recorded in the checkpoint as they complete.
+
+    Returns a tuple of the lists of (done, skipped, failed) relative paths.
+    """
+    limiter = rate_limiter(rate)
+    progress = checkpoint(checkpoint_path, checkpoint.run_of(
+        configurations, section_name, instruction, alternate, output))
+
+    # Never process the checkpoint itself when it lives in the tree
+    checkpoint_file = os.path.abspath(checkpoint_path) \
+        if checkpoint_path is not None else None
+    relpaths = [relpath for relpath in find_files(root, include, exclude)
+                if os.path.abspath(os.path.join(root, relpath)) !=
+                checkpoint_file]
+
+    done, skipped, failed = [], [], []
+
+    def process(relpath):
+        with open(os.path.join(root, relpath), "r", encoding="utf-8") as source_io:
+            text = source_io.read()
+
+        if progress.is_done(relpath, text):
+            return "skipped"
+
+        limiter.wait()
+        result = process_text(configurations, section_name, text,
+                              instruction, alternate,
+                              relpath.endswith(".py"))
+
+        target_root = output if output is not None else root
+        atomic_write(os.path.join(target_root, relpath), result)
+        progress.mark_done(relpath, text, result)
+        return "done"
+
+    executor = ThreadPoolExecutor(max_workers=max(jobs, 1))
+    futures = dict((executor.submit(process, relpath), relpath)
+                   for relpath in relpaths)
+    try:
+        for count, future in enumerate(as_completed(futures), 1):
+            relpath = futures[future]
+            try:
+                status = future.result()
+            except Exception as e:
+                logger.error("Failed %s: %s", relpath, e)
+                status = "failed"
+
+            {"done": done, "skipped": skipped,
+             "failed": failed}[status].append(relpath)
+            report("[{}/{}] {} {}".format(count, len(futures), status,
+                                          relpath))
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+    return done, skipped, failed
@@ -0,0 +1,261 @@
+import json
+import re
+from time import sleep
+
+from .logs import logger
+from .prompt import estimate_tokens
+from .routing import router
+
+
+def load_settings(*paths):
+    """
+    Loads Sublime Text settings files, which are JSON allowing comments and
+    trailing commas. Top-level keys of later files replace the ones of
+    earlier files, as Sublime Text does with the User settings.
+    """
+    string = r'("(?:\\.|[^"\\])*")'
+    comments = re.compile(string + r'|//[^\n]*|/\*.*?\*/', re.DOTALL)
+    trailing_commas = re.compile(string + r'|,(?=\s*[}\]])')
+
+    def keep_strings(match):
+        return match.group(1) or ""
+
+    configurations = {}
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as settings_io:
+            text = comments.sub(keep_strings, settings_io.read())
+        text = trailing_commas.sub(keep_strings, text)
+        configurations.update(json.loads(text))
+    return configurations
+
+
+class configurator():
+    """
+    Merges the global, section and alternate configurations of a command.
+
+    The alternate is, in order of precedence, the one requested explicitly,
+    the "default" alternate, the one chosen by routing or the one returned
+    by select_alternate, which subclasses override to ask the user.
+    """
+
+    def __init__(self, configurations, section_name, base_obj=None,
+                 request_text="", alternate=None):
+        self.base_obj = base_obj
+        self.__section_cursor__ = section_name
+        self.section_name = section_name
+        self.alternate_name = None
+        self.requested_alternate = alternate
+        self.request_text = request_text
+        self.routing_decision = None
+
+        self.cancelled = False  
+
+        self.source_config__meta__ = configurations.get("__meta__", {})
+
+        # Read Sublime Text configuration object
+        self.source_config = {}
+        self.source_config["oai"] = configurations.get("oai", {})
+        self.source_config[section_name] = configurations.get(section_name, {})
+
+        # print("Source configuration")
+        # print(self.source_config)
+
+        # Read the section configuration
+        self.__running_config__ = {}
+        self.__running_config__["alternates"] = configurations.get(
+            "alternates", {})
+        self.__configuration__completed__ = False
+        self.__construct__running__config__()
+
+    def __construct__running__config__(self):
+
+        def populate_dict(input_dict, target_dict):
+
+            def merge_value(input_val, target_val, key):
+                # Consider merging different value types , e.g. string personas based on key
+
+                target_prio_str_keys = [ 
+                    "prompt"
+                ]
+                target_prio_str_keys = self.source_config__meta__.get("target_prio_str_keys", target_prio_str_keys)
+
+                input_prio_str_keys = self.source_config__meta__.get("target_prio_str_keys", [])
+
+                input_prio_keys = self.source_config__meta__.get("target_prio_str_keys", [])
+
+                if key in target_prio_str_keys:
+                    return target_val + "\n\n" + input_val
+                elif key in input_prio_str_keys:
+                    return input_val + "\n\n" + target_val
+                elif key in input_prio_keys:
+                    return input_val
+                else:
+                    return target_val
+
+
+            def merge_dict_value(lhs, rhs, k):
+                if isinstance(lhs,dict):
+                    dict_val = lhs
+                    val = rhs
+                else:
+                    dict_val = rhs
+                    val = lhs
+
+                merged = dict_val
+                merged[k] = val
+
+                return merged
+
+
+            def merge_dict(k):
+                # Return value if key ony exists in the target dictionary
+                if k in target_dict.keys() and k not in input_dict.keys():
+                    return target_dict[k]
+
+                # Return value if key only exists in the input dictionary 
+                if k in input_dict.keys() and k not in target_dict.keys():
+                    return input_dict[k]
+
+                # Merge value according to rules if key exists in both and is a value for both
+                if k in input_dict.keys() and k in target_dict.keys():
+                    if not isinstance(input_dict[k],dict) and not isinstance(target_dict[k], dict):
+                        return merge_value(input_dict[k], target_dict[k], k)
+
+                if k in input_dict.keys() and k in target_dict.keys():
+                    if isinstance(input_dict[k], dict) and isinstance(target_dict[k],dict):
+                        # Merge dictionaries if key exists in both an is a dictionary
+                        return populate_dict(input_dict[k], target_dict[k])
+                    elif isinstance(input_dict[k], dict) or isinstance(target_dict[k], dict):
+                        # Merge dictionary with value if key exists in both
+                        return merge_dict_value(input_dict[k],target_dict[k], k)
+
+
+            keys = set(list(target_dict.keys()) + list(input_dict.keys()))
+            return {k: merge_dict(k) for k in keys}
+
+
+        # Construct oai configuration from global and section
+        default_oai = self.source_config["oai"]
+        self.__running_config__ = populate_dict(
+            default_oai, self.__running_config__)
+
+        section_config = self.source_config[self.__section_cursor__]
+        self.__running_config__ = populate_dict(
+            section_config, self.__running_config__)
+
+        def replace_config(config_name):
+            if config_name:
+                alternates = self.__running_config__["alternates"]
+                config_override = alternates[config_name]
+                self.__running_config__ = populate_dict(
+                    self.__running_config__, config_override)
+                self.alternate_name = config_name
+
+        def on_done(index):
+            if index == -1:
+                self.cancelled = True  
+            else:
+                configs_list = ["__default__"]
+                configs_list += list(alternates.keys())
+                selected_config = configs_list[index]
+                if selected_config != "__default__":
+                    replace_config(selected_config)
+            self.__configuration__completed__ = True
+
+        default_alternate = self.__running_config__[
+            "alternates"].get("default", None)
+        routing = self.__running_config__.get("routing", {})
+        routed_config = None
+        if self.requested_alternate is None and default_alternate is None \
+                and routing.get("enabled", False):
+            routed_config = self.route_alternate(routing)
+
+        if self.requested_alternate is not None:
+            replace_config(self.requested_alternate)
+            self.__configuration__completed__ = True
+        elif default_alternate is not None:
+            replace_config(default_alternate)
+            self.__configuration__completed__ = True
+        elif routed_config is not None:
+            selected_config = routed_config
+            if selected_config != "__default__":
+                replace_config(selected_config)
+            self.__configuration__completed__ = True
+        else:
+            alternates = self.__running_config__["alternates"]
+            self.select_alternate(
+                ["default"] + list(alternates.keys()), on_done)
+
+        # print("Before selection configuration \n\n")
+        # print(self.__running_config__)
+
+    def select_alternate(self, items, on_done):
+        """
+        Selects one of the alternates and calls on_done with its index, or -1
+        to cancel. Without a user to ask the default configuration is used.
+        """
+        on_done(0)
+
+    def route_alternate(self, routing):
+        """
+        Chooses the alternate using the estimated size of the request and the
+        observed latency of each alternate instead of asking the user.
+        Returns None when no candidate is left to route to.
+        """
+        alternates = self.__running_config__["alternates"]
+        allowed = routing.get("candidates", None)
+
+        output_tokens = estimate_tokens(self.request_text)
+        candidates = {}
+        for name, override in [("__default__", {})] + list(alternates.items()):
+            if not isinstance(override, dict):
+                continue
+            if allowed is not None and name not in allowed:
+                continue
+
+            def lookup(key, default=None):
+                return override.get(key,
+                                    self.__running_config__.get(key, default))
+
+            prompt = self.__running_config__.get("prompt", "") + \
+                override.get("prompt", "")
+            input_tokens = estimate_tokens(
+                prompt + lookup("persona", "") + self.request_text)
+            candidates[name] = {
+                "input_tokens": input_tokens,
+                "output_tokens": min(lookup("max_tokens", 100), output_tokens),
+                "context_tokens": lookup("context_tokens", None)
+            }
+
+        if not candidates:
+            logger.warning("No routing candidate among %s, routing skipped",
+                           allowed)
+            return None
+
+        selected_config, reason = router.choose(candidates)
+        self.routing_decision = "{} ({})".format(selected_config, reason)
+        return selected_config
+
+    def ready_wait(self, sleep_duration=0.2):
+        while not self.__configuration__completed__:
+            sleep(sleep_duration)
+
+    def is_cancelled(self):
+        self.ready_wait()
+        return self.cancelled
+
+    def get_prompt(self, default=""):
+        self.ready_wait()
+        return self.__running_config__.get("prompt", default)
+
+    def get_persona(self, default="You are a helpful AI Assistant"):
+        self.ready_wait()
+        return self.__running_config__.get("persona", default)
+
+    def get_model(self, default="gpt-4"):
+        self.ready_wait()
+        return self.__running_config__.get("model", default)
+
+    def get(self, key, default=None):
+        self.ready_wait()
+        return self.__running_config__.get(key, default)
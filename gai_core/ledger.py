@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import threading
+
+from .logs import logger
+
+
+class usage_ledger():
+    """
+    An append-only ledger of token usage stored as compact JSON lines.
+
+    Each line records one response: timestamp (ts), section (sec), alternate
+    (alt), model, prompt/completion/total tokens (pt/ct/tt), latency in
+    milliseconds (ms), cache hit flag (hit) and cost.
+
+    Methods
+    -------
+    record(section, alternate, model, usage, latency, cost):
+
+        Appends a response usage to the ledger.
+
+    check_budget(budget, section, model, pending_tokens, pending_cost):
+
+        Checks the daily budget before a request is sent.
+
+    aggregate(group_by):
+
+        Aggregates the ledger per day, section and/or model.
+    """
+
+    __ledgers__ = {}
+    __ledgers_lock__ = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+        # Running totals of the current day, loaded lazily from the ledger
+        self.__day__ = None
+        self.__day_totals__ = {}
+
+    @classmethod
+    def for_path(cls, path):
+        """
+        Returns the ledger shared by all requests writing to the given path.
+        """
+        path = os.path.abspath(os.path.expanduser(path))
+        with cls.__ledgers_lock__:
+            if path not in cls.__ledgers__:
+                cls.__ledgers__[path] = cls(path)
+            return cls.__ledgers__[path]
+
+    @staticmethod
+    def day_of(timestamp):
+        return time.strftime("%Y-%m-%d", time.localtime(timestamp))
+
+    @staticmethod
+    def price(pricing, model, prompt_tokens, completion_tokens):
+        """
+        Computes the cost of a response given a pricing table per 1K tokens,
+        e.g. {"gpt-4": {"prompt": 0.03, "completion": 0.06}}.
+        """
+        rates = (pricing or {}).get(model, {})
+        return (prompt_tokens * rates.get("prompt", 0) +
+                completion_tokens * rates.get("completion", 0)) / 1000.0
+
+    def entries(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as ledger_io:
+            for line in ledger_io:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning("Skipping corrupt ledger line: %s", line)
+
+    def __scope_keys__(self, entry):
+        return ["all",
+                "section:" + str(entry.get("sec")),
+                "model:" + str(entry.get("model"))]
+
+    def __add_to_day__(self, entry):
+        for key in self.__scope_keys__(entry):
+            totals = self.__day_totals__.setdefault(key, [0, 0.0])
+            totals[0] += entry.get("tt", 0)
+            totals[1] += entry.get("cost", 0.0)
+
+    def __refresh_day__(self):
+        today = self.day_of(time.time())
+        if self.__day__ == today:
+            return
+
+        self.__day__ = today
+        self.__day_totals__ = {}
+        for entry in self.entries():
+            if self.day_of(entry.get("ts", 0)) == today:
+                self.__add_to_day__(entry)
+
+    def record(self, section, alternate, model, usage, latency, cost=0.0):
+        prompt_details = usage.get("prompt_tokens_details") or {}
+        entry = {
+            "ts": round(time.time(), 3),
+            "sec": section,
+            "alt": alternate,
+            "model": model,
+            "pt": usage.get("prompt_tokens", 0),
+            "ct": usage.get("completion_tokens", 0),
+            "tt": usage.get("total_tokens", 0),
+            "ms": int(latency * 1000),
+            "hit": prompt_details.get("cached_tokens", 0) > 0,
+            "cost": round(cost, 6)
+        }
+
+        with self.lock:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.path, "a", encoding="utf-8") as ledger_io:
+                ledger_io.write(json.dumps(entry, separators=(",", ":")))
+                ledger_io.write("\n")
+
+            if self.__day__ == self.day_of(entry["ts"]):
+                self.__add_to_day__(entry)
+
+        return entry
+
+    def check_budget(self, budget, section, model, pending_tokens=0,
+                     pending_cost=0.0):
+        """
+        Checks today's usage, including the pending request, against a budget
+        of the form {"scope": "all"|"section"|"model", "soft_tokens": N,
+        "hard_tokens": N, "soft_cost": X, "hard_cost": X}.
+
+        Returns a tuple (level, message) where level is None, "soft" or
+        "hard". A hard level means the request must not be sent.
+        """
+        if not budget:
+            return None, None
+
+        scope = budget.get("scope", "all")
+        key = {"section": "section:" + str(section),
+               "model": "model:" + str(model)}.get(scope, "all")
+
+        with self.lock:
+            self.__refresh_day__()
+            tokens, cost = self.__day_totals__.get(key, [0, 0.0])
+
+        tokens += pending_tokens
+        cost += pending_cost
+
+        for level in ["hard", "soft"]:
+            token_limit = budget.get(level + "_tokens", None)
+            if token_limit is not None and tokens > token_limit:
+                return level, "{} token budget exceeded for {}: {}/{}".format(
+                    level.capitalize(), key, tokens, token_limit)
+
+            cost_limit = budget.get(level + "_cost", None)
+            if cost_limit is not None and cost > cost_limit:
+                return level, "{} cost budget exceeded for {}: {:.4f}/{}".format(
+                    level.capitalize(), key, cost, cost_limit)
+
+        return None, None
+
+    def aggregate(self, group_by=("day",)):
+        """
+        Aggregates requests, tokens, cost, cache hits and latency of the
+        ledger grouped by any combination of "day", "section", "alternate"
+        and "model".
+        """
+        fields = {
+            "day": lambda entry: self.day_of(entry.get("ts", 0)),
+            "section": lambda entry: str(entry.get("sec")),
+            "alternate": lambda entry: str(entry.get("alt")),
+            "model": lambda entry: str(entry.get("model"))
+        }
+
+        groups = {}
+        for entry in self.entries():
+            key = tuple(fields[field](entry) for field in group_by)
+            group = groups.setdefault(key, {
+                "requests": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                "total_tokens": 0, "cost": 0.0, "cache_hits": 0,
+                "latency_ms": 0
+            })
+            group["requests"] += 1
+            group["prompt_tokens"] += entry.get("pt", 0)
+            group["completion_tokens"] += entry.get("ct", 0)
+            group["total_tokens"] += entry.get("tt", 0)
+            group["cost"] += entry.get("cost", 0.0)
+            group["cache_hits"] += 1 if entry.get("hit") else 0
+            group["latency_ms"] += entry.get("ms", 0)
+
+        return groups
+
+    def report(self, group_by_list=(("day",), ("section",), ("model",))):
+        """
+        Renders the aggregated ledger as plain text tables.
+        """
+        lines = ["GAI usage report - {}".format(self.path), ""]
+        for group_by in group_by_list:
+            groups = self.aggregate(group_by)
+            header = "{:<40} {:>8} {:>12} {:>12} {:>12} {:>10} {:>6} {:>10}"
+            lines.append("Per " + " / ".join(group_by))
+            lines.append(header.format(
+                " / ".join(group_by), "requests", "prompt", "completion",
+                "total", "cost", "hits", "avg ms"))
+            for key in sorted(groups.keys()):
+                group = groups[key]
+                lines.append(header.format(
+                    " / ".join(key)[:40], group["requests"],
+                    group["prompt_tokens"], group["completion_tokens"],
+                    group["total_tokens"], "{:.4f}".format(group["cost"]),
+                    group["cache_hits"],
+                    group["latency_ms"] // max(group["requests"], 1)))
+            lines.append("")
+        return "\n".join(lines)
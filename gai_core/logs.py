@@ -0,0 +1,58 @@
+import os
+import logging
+
+# Create the logger shared by the plugin and the core
+logger = logging.getLogger(__package__)
+logger.setLevel(logging.DEBUG)
+
+# Create a formatter and attach it to the handlers
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+def setup_logs(config_handle):
+    """
+    Adds the stream and file handlers requested by the configuration if they
+    are not already present.
+
+    Returns the file handler added, if any, so that it can be removed once
+    the request is done.
+    """
+
+    def stream_handler_added():
+        return any(isinstance(handler, logging.StreamHandler)
+            for handler in logger.handlers)
+
+    def same(cur_handler, lfile):
+        cur_file = os.path.abspath(cur_handler.baseFilename)
+        return cur_file == os.path.abspath(lfile)
+
+    def file_handler_added(logfile):
+        return any(isinstance(handler, logging.FileHandler)
+            and same(handler, logfile) for handler in logger.handlers)
+
+    # Add a stream handler if not already defined given configuration
+    if config_handle.get("log_level", None) is not None:
+        if not stream_handler_added():
+            stream_handler = logging.StreamHandler()
+            stream_handler.setFormatter(formatter)
+            logger.addHandler(stream_handler)
+
+    # Add a file handler if not already present given configuration
+    file_log_io = config_handle.get("log_file", None)
+
+    if file_log_io is not None and not file_handler_added(file_log_io):
+        file_handler = logging.FileHandler(file_log_io)
+        file_handler.setFormatter(formatter)
+        logger.addHandler(file_handler)
+        return file_handler
+
+    return None
+
+
+def remove_logs(file_handler):
+    """
+    Closes and removes a file handler added by setup_logs.
+    """
+    if file_handler is not None:
+        file_handler.close()
+        logger.removeHandler(file_handler)
@@ -0,0 +1,180 @@
+import re
+
+from .logs import logger
+from .transport import request_completion
+
+HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+def strip_fences(content):
+    """
+    Removes the markdown code fences models tend to wrap answers with.
+    """
+    lines = content.strip("\n").split("\n")
+    if lines and lines[0].startswith("```"):
+        lines = lines[1:]
+    if lines and lines[-1].startswith("```"):
+        lines = lines[:-1]
+    return "\n".join(lines)
+
+
+def split_lines(text):
+    """
+    Returns the lines of a text and whether it ends with a new line.
+    """
+    if text.endswith("\n"):
+        return text[:-1].split("\n"), True
+    return text.split("\n"), False
+
+
+def join_lines(lines, trailing_newline):
+    return "\n".join(lines) + ("\n" if trailing_newline else "")
+
+
+def parse_hunks(diff):
+    """
+    Parses the hunks of a unified diff into (old start, old lines, new
+    lines). Blank lines inside a hunk are taken as blank context lines, and
+    "---"/"+++" lines are only file headers right before a hunk header.
+    """
+    lines = diff.split("\n")
+    file_headers = set()
+    for position in range(len(lines) - 2):
+        if lines[position].startswith("---") and \
+                lines[position + 1].startswith("+++") and \
+                HUNK_HEADER.match(lines[position + 2]):
+            file_headers.update((position, position + 1))
+
+    hunks = []
+    current = None
+    for position, line in enumerate(lines):
+        header = HUNK_HEADER.match(line)
+        if header:
+            current = (int(header.group(1)), [], [])
+            hunks.append(current)
+        elif current is None or position in file_headers or \
+                line.startswith("\\"):
+            continue
+        elif line.startswith("-"):
+            current[1].append(line[1:])
+        elif line.startswith("+"):
+            current[2].append(line[1:])
+        elif line.startswith(" ") or line == "":
+            current[1].append(line[1:])
+            current[2].append(line[1:])
+        else:
+            raise ValueError("Unexpected line in diff: {!r}".format(line))
+
+    # Trailing blank lines are the end of the answer, not context
+    for start, old_lines, new_lines in hunks:
+        while old_lines and new_lines and old_lines[-1] == "" and \
+                new_lines[-1] == "":
+            old_lines.pop()
+            new_lines.pop()
+    return hunks
+
+
+def apply_unified_diff(original, diff):
+    """
+    Applies a unified diff to a text. Hunks are located at their line
+    number, or the closest position where their old lines match ignoring
+    trailing white space. Raises ValueError if any hunk does not apply.
+    """
+    hunks = parse_hunks(strip_fences(diff))
+    if not hunks:
+        raise ValueError("No hunk found in the diff")
+
+    lines, trailing_newline = split_lines(original)
+    offset = 0
+    for start, old_lines, new_lines in hunks:
+        expected = max(start - 1, 0) + offset
+        if not old_lines:
+            # Pure insertion, the start is the line after which to insert
+            position = min(start + offset, len(lines))
+        else:
+            def matches(position):
+                candidate = lines[position:position + len(old_lines)]
+                return len(candidate) == len(old_lines) and all(
+                    a.rstrip() == b.rstrip()
+                    for a, b in zip(candidate, old_lines))
+
+            positions = [position for position in
+                         range(len(lines) - len(old_lines) + 1)
+                         if matches(position)]
+            if not positions:
+                raise ValueError("Hunk at line {} does not apply".format(
+                    start))
+            position = min(positions,
+                           key=lambda position: abs(position - expected))
+
+        lines[position:position + len(old_lines)] = new_lines
+        offset += len(new_lines) - len(old_lines)
+
+    return join_lines(lines, trailing_newline)
+
+
+def apply_search_replace(original, blocks):
+    """
+    Applies search/replace blocks to a text, each search text having to
+    occur exactly once. Raises ValueError otherwise.
+    """
+    parsed = []
+    state = None
+    for line in strip_fences(blocks).split("\n"):
+        if line.startswith("<<<<<<<"):
+            state = "search"
+            parsed.append(([], []))
+        elif line.startswith("=======") and state == "search":
+            state = "replace"
+        elif line.startswith(">>>>>>>") and state == "replace":
+            state = None
+        elif state == "search":
+            parsed[-1][0].append(line)
+        elif state == "replace":
+            parsed[-1][1].append(line)
+
+    if not parsed or state is not None:
+        raise ValueError("No complete search/replace block found")
+
+    text = original
+    for search_lines, replace_lines in parsed:
+        search = "\n".join(search_lines)
+        if not search.strip():
+            raise ValueError("Empty search block")
+
+        occurrences = text.count(search)
+        if occurrences != 1:
+            raise ValueError("Search block found {} times: {!r}".format(
+                occurrences, search))
+        text = text.replace(search, "\n".join(replace_lines), 1)
+
+    return text
+
+
+def apply_patch(original, content, edit_format):
+    if edit_format == "diff":
+        return apply_unified_diff(original, content)
+    if edit_format == "search_replace":
+        return apply_search_replace(original, content)
+    raise ValueError("Unknown edit format: {}".format(edit_format))
+
+
+def request_edit(config_handle, data, fallback_data, source, edit_format,
+                 ledger=None, notify=None):
+    """
+    Requests the edit of source as a patch and applies it locally. When the
+    patch does not apply cleanly the full rewrite is requested instead with
+    fallback_data.
+
+    Returns a tuple (content, usage) as request_completion does.
+    """
+    content, usage = request_completion(config_handle, data, ledger, notify)
+    try:
+        return apply_patch(source, content, edit_format), usage
+    except ValueError as e:
+        logger.warning("Patch did not apply, requesting a full rewrite: %s",
+                       e)
+        if notify is not None:
+            notify("Patch did not apply, requesting a full rewrite")
+
+    return request_completion(config_handle, fallback_data, ledger, notify)
@@ -0,0 +1,44 @@
+import os
+import fnmatch
+
+
+def matches_globs(relpath, patterns):
+    """
+    Returns whether a relative path, or its file name, matches any glob.
+    """
+    return any(fnmatch.fnmatch(relpath, pattern) or
+               fnmatch.fnmatch(os.path.basename(relpath), pattern)
+               for pattern in patterns)
+
+
+def is_excluded(relpath, exclude):
+    """
+    Returns whether a relative path with forward slashes, or any of its
+    parent directories, matches an exclude glob, as find_files prunes them.
+    """
+    parts = relpath.split("/")
+    return any(matches_globs("/".join(parts[:count]), exclude)
+               for count in range(1, len(parts) + 1))
+
+
+def find_files(root, include=("*",), exclude=()):
+    """
+    Walks a directory and returns the sorted relative paths, with forward
+    slashes, matching any of the include globs and none of the exclude
+    globs. Directories matching an exclude glob are not walked.
+    """
+    found = []
+    for directory, dirnames, filenames in os.walk(root):
+        reldir = os.path.relpath(directory, root).replace(os.sep, "/")
+        reldir = "" if reldir == "." else reldir + "/"
+
+        dirnames[:] = [dirname for dirname in dirnames
+                       if not matches_globs(reldir + dirname, exclude)]
+
+        for filename in filenames:
+            relpath = reldir + filename
+            if matches_globs(relpath, include) and \
+                    not matches_globs(relpath, exclude):
+                found.append(relpath)
+
+    return sorted(found)
@@ -0,0 +1,173 @@
+import io
+import sys
+import time
+import threading
+
+try:
+    import cProfile
+    import pstats
+except ImportError:
+    cProfile = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from .logs import logger
+
+# From Python 3.12 a profile follows every thread and only one can be active
+PROCESS_WIDE_PROFILE = sys.version_info >= (3, 12)
+
+
+class request_profiler():
+    """
+    Profiles the stages of one request, which run on different threads.
+
+    Before Python 3.12 cProfile only profiles the thread it is enabled on,
+    so every stage runs under its own profile. From Python 3.12 a single
+    profile covers all the threads of the request. tracemalloc traces the
+    allocations of all the threads from start to stop.
+
+    Profiling never fails the request: when another profiling tool is
+    active the stages run without profile and only their duration is
+    reported.
+
+    Methods
+    -------
+    start():
+
+        Starts tracing the allocations, and profiling from Python 3.12.
+
+    profile(label, function, *args, **kwargs):
+
+        Runs a stage of the request, under cProfile before Python 3.12.
+
+    stop():
+
+        Stops tracing and takes the allocations snapshot.
+
+    report(top=30):
+
+        Renders the profiles sorted by cumulative time and the top
+        allocation sites.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = []
+        self.request_profile = None
+        self.profiler_busy = False
+        self.started_tracing = False
+        self.started_at = None
+        self.wall_seconds = None
+        self.snapshot = None
+        self.traced_memory = None
+
+    def enable(self, profile):
+        """
+        Enables a profile, returns None when another profiler is active.
+        """
+        try:
+            profile.enable()
+        except ValueError as e:
+            logger.warning("Request not profiled: %s", e)
+            self.profiler_busy = True
+            return None
+        return profile
+
+    def start(self):
+        self.started_at = time.time()
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            self.started_tracing = True
+        if cProfile is not None and PROCESS_WIDE_PROFILE:
+            self.request_profile = self.enable(cProfile.Profile())
+
+    def profile(self, label, function, *args, **kwargs):
+        profile = None
+        if cProfile is not None and not PROCESS_WIDE_PROFILE:
+            profile = self.enable(cProfile.Profile())
+
+        stage_start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stage_seconds = time.time() - stage_start
+            if profile is not None:
+                profile.disable()
+            # Stages still running when the report is rendered are left out
+            with self.lock:
+                self.stages.append((label, threading.current_thread().name,
+                                    stage_seconds, profile))
+
+    def stop(self):
+        if self.started_at is not None:
+            self.wall_seconds = time.time() - self.started_at
+
+        if self.request_profile is not None:
+            self.request_profile.disable()
+
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            self.traced_memory = tracemalloc.get_traced_memory()
+            self.snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<unknown>")])
+            # A tracing session started by someone else is left running
+            if self.started_tracing:
+                tracemalloc.stop()
+
+    @staticmethod
+    def render(profile, top):
+        stream = io.StringIO()
+        stats = pstats.Stats(profile, stream=stream)
+        stats.sort_stats("cumulative").print_stats(top)
+        return stream.getvalue().strip("\n")
+
+    def report(self, top=30):
+        lines = ["GAI request profile - {}".format(
+            time.strftime("%Y-%m-%d %H:%M:%S",
+                          time.localtime(self.started_at or time.time())))]
+        if self.wall_seconds is not None:
+            lines.append("Wall time: {:.3f}s".format(self.wall_seconds))
+        lines.append("")
+
+        with self.lock:
+            stages = list(self.stages)
+        if cProfile is None:
+            lines.append("cProfile is not available in this interpreter")
+            lines.append("")
+        elif self.profiler_busy:
+            lines.append("Not fully profiled, another profiling tool was "
+                         "active")
+            lines.append("")
+
+        for label, thread_name, seconds, profile in stages:
+            lines.append("== {} ({}) - {:.3f}s ==".format(label, thread_name,
+                                                         seconds))
+            if profile is not None:
+                lines.append(self.render(profile, top))
+            lines.append("")
+
+        if self.request_profile is not None:
+            lines.append("== All threads ==")
+            lines.append(self.render(self.request_profile, top))
+            lines.append("")
+
+        lines.append("== Memory ==")
+        if self.traced_memory is None:
+            lines.append("tracemalloc is not available in this interpreter")
+            return "\n".join(lines) + "\n"
+
+        current, peak = self.traced_memory
+        lines.append("Current: {:.1f} KiB, peak: {:.1f} KiB".format(
+            current / 1024.0, peak / 1024.0))
+        lines.append("Top allocation sites:")
+        for statistic in self.snapshot.statistics("lineno")[:top]:
+            frame = statistic.traceback[0]
+            lines.append("  {}:{}: {:.1f} KiB in {} blocks".format(
+                frame.filename, frame.lineno, statistic.size / 1024.0,
+                statistic.count))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,63 @@
+EDIT_FORMAT_PROMPTS = {
+    "diff": (
+        "Answer only with a unified diff of the changes to the code below, "
+        "its lines numbered from 1, with @@ hunk headers and 3 lines of "
+        "context. Do not repeat unchanged code outside of the context "
+        "lines."),
+    "search_replace": (
+        "Answer only with search/replace blocks for the changes to the code "
+        "below, each of the form:\n<<<<<<< SEARCH\n<lines of the code, "
+        "unique and exactly as they are>\n=======\n<replacement lines>\n"
+        ">>>>>>> REPLACE\nDo not repeat unchanged code outside of the "
+        "search lines.")
+}
+
+
+def estimate_tokens(text):
+    """
+    Roughly estimates the number of tokens of a text, assuming four
+    characters per token.
+    """
+    return len(text) // 4 + 1
+
+
+def build_request(config_handle, code_region, instruction="", context="",
+                  edit_format=None):
+    """
+    Builds the chat completion request for a code region, with the context
+    retrieved from the project, if any, in front of the prompt. With an
+    edit_format ("diff" or "search_replace") the answer is asked as a patch
+    of the code region instead of the whole code.
+
+    Returns a tuple (data, text) where data is the request body and text is
+    the prompt text to keep in front of the result.
+    """
+    if edit_format is not None:
+        if edit_format not in EDIT_FORMAT_PROMPTS:
+            raise ValueError("Unknown edit format: {}".format(edit_format))
+        instruction = "{} {}".format(instruction,
+                                     EDIT_FORMAT_PROMPTS[edit_format])
+
+    code_prompt = config_handle.get_prompt()
+    user_code_content = "{}{} {} {}".format(
+        context, code_prompt, instruction, code_region)
+
+    data = {
+        'messages': [{
+            'role': 'system',
+            'content': config_handle.get_persona(),
+        }, {
+            'role': 'user',
+            'content': user_code_content
+        }],
+        'model': config_handle.get_model(),
+        'max_tokens': config_handle.get('max_tokens', 100),
+        'temperature': config_handle.get('temperature', 0),
+        'top_p': config_handle.get('top_p', 1)
+    }
+
+    text = ""
+    if config_handle.get('keep_prompt_text', False):
+        text = code_region
+
+    return data, text
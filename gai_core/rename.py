@@ -0,0 +1,550 @@
+import io
+import re
+import ast
+import json
+import keyword
+import builtins
+import symtable
+import tokenize
+from collections import OrderedDict
+
+from .logs import logger
+from .prompt import estimate_tokens
+from .transport import request_completion
+
+DEFAULT_RENAME_PROMPT = (
+    "Suggest related but not the same names for the following Python "
+    "identifiers, keeping their naming style (snake_case or CamelCase). "
+    "Answer only with a JSON object mapping each name to its new name.\n")
+
+# Names that are never renamed, beside dunder names and builtins
+RESERVED_NAMES = set(["self", "cls", "_", "match", "case", "type"])
+
+SYNONYMS = {
+    "add": "append", "append": "add", "arg": "param", "args": "params",
+    "buffer": "buf", "build": "make", "calc": "compute",
+    "calculate": "compute", "check": "verify", "compute": "calculate",
+    "config": "settings", "count": "total", "create": "make",
+    "data": "payload", "delete": "remove", "dict": "mapping",
+    "element": "item", "entry": "record", "error": "fault",
+    "fetch": "retrieve", "file": "document", "find": "lookup",
+    "get": "fetch", "handle": "process", "index": "position",
+    "info": "details", "init": "setup", "item": "element",
+    "items": "elements", "key": "identifier", "length": "size",
+    "list": "sequence", "load": "read", "make": "build",
+    "manager": "handler", "message": "notice", "name": "label",
+    "node": "vertex", "num": "count", "number": "amount",
+    "obj": "instance", "parse": "decode", "path": "location",
+    "process": "handle", "read": "load", "record": "entry",
+    "remove": "delete", "request": "query", "response": "reply",
+    "result": "outcome", "results": "outcomes", "run": "execute",
+    "save": "store", "set": "assign", "size": "length",
+    "start": "begin", "status": "state", "store": "save",
+    "sum": "total", "text": "content", "total": "overall",
+    "update": "refresh", "user": "account", "validate": "check",
+    "value": "amount", "values": "amounts", "write": "emit"
+}
+
+
+class identifier_collector(ast.NodeVisitor):
+    """
+    Collects the identifiers bound in a piece of Python code together with
+    their kind and scope, and the names that must not be renamed because
+    they are bound outside of it.
+    """
+
+    def __init__(self):
+        self.scopes = [("module", "<module>")]
+        self.identifiers = OrderedDict()
+        self.attributes = set()
+        self.parameters = set()
+        self.protected = set()
+        self.classes = set()
+        self.callables = {}
+        self.attribute_accesses = []
+
+    def scope_name(self):
+        return ".".join(name for kind, name in self.scopes[1:]) or "<module>"
+
+    def define(self, name, kind):
+        if name not in self.identifiers:
+            self.identifiers[name] = {"name": name, "kind": kind,
+                                      "scope": self.scope_name()}
+
+    def visit_scope(self, node, kind):
+        self.scopes.append((kind, node.name))
+        self.generic_visit(node)
+        self.scopes.pop()
+
+    def visit_FunctionDef(self, node):
+        arguments = node.args
+        parameters = set(argument.arg for argument in
+                         getattr(arguments, "posonlyargs", []) +
+                         arguments.args + arguments.kwonlyargs)
+        self.callables.setdefault(node.name, set()).update(parameters)
+
+        if self.scopes[-1][0] == "class":
+            self.define(node.name, "method")
+            self.attributes.add(node.name)
+            if node.name == "__init__":
+                # Calling the class passes the arguments of __init__
+                self.callables.setdefault(self.scopes[-1][1], set()).update(
+                    parameters)
+        else:
+            self.define(node.name, "function")
+        self.visit_scope(node, "function")
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_ClassDef(self, node):
+        self.define(node.name, "class")
+        self.classes.add(node.name)
+        self.callables.setdefault(node.name, set())
+        self.visit_scope(node, "class")
+
+    def visit_arg(self, node):
+        self.define(node.arg, "parameter")
+        self.parameters.add(node.arg)
+        self.generic_visit(node)
+
+    def visit_Name(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            if self.scopes[-1][0] == "class":
+                self.define(node.id, "class attribute")
+                self.attributes.add(node.id)
+            else:
+                self.define(node.id, "variable")
+
+    def visit_Attribute(self, node):
+        receiver = node.value.id if isinstance(node.value, ast.Name) \
+            else None
+        self.attribute_accesses.append((receiver, node.attr))
+        if not isinstance(node.ctx, ast.Load) and \
+                isinstance(node.value, ast.Name) and \
+                node.value.id in ("self", "cls"):
+            self.define(node.attr, "attribute")
+            self.attributes.add(node.attr)
+        self.generic_visit(node)
+
+    def visit_ExceptHandler(self, node):
+        if node.name:
+            self.define(node.name, "variable")
+        self.generic_visit(node)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self.protected.add((alias.asname or alias.name).split(".")[0])
+
+    visit_ImportFrom = visit_Import
+
+    def visit_Global(self, node):
+        self.protected.update(node.names)
+
+    visit_Nonlocal = visit_Global
+
+    def owns(self, receiver):
+        """
+        Returns whether the attributes of a receiver name are the ones
+        defined in the source.
+        """
+        return receiver in ("self", "cls") or receiver in self.classes
+
+    def foreign_attributes(self):
+        """
+        Returns the attribute names also accessed on objects that may not be
+        defined in the source, such as parameters or imported modules.
+        """
+        return set(attribute for receiver, attribute in
+                   self.attribute_accesses if not self.owns(receiver))
+
+
+def parse(source):
+    """
+    Parses a selection, which may be indented as a whole. Returns the tree
+    and the code actually parsed.
+    """
+    try:
+        return ast.parse(source), source
+    except SyntaxError:
+        pass
+
+    code = "if True:\n" + source
+    try:
+        return ast.parse(code), code
+    except SyntaxError as e:
+        raise ValueError("Selection is not valid Python: {}".format(e))
+
+
+def free_names(code):
+    """
+    Returns the names read somewhere they are not bound by the code itself,
+    which refer to bindings outside of the selection.
+    """
+    module = symtable.symtable(code, "<selection>", "exec")
+    module_names = set(symbol.get_name() for symbol in module.get_symbols()
+                       if symbol.is_local())
+
+    free = set()
+    tables = [module]
+    while tables:
+        table = tables.pop()
+        tables.extend(table.get_children())
+        for symbol in table.get_symbols():
+            if not symbol.is_referenced() or symbol.is_local() or \
+                    symbol.is_free():
+                continue
+            if symbol.is_global() and symbol.get_name() in module_names:
+                continue
+            free.add(symbol.get_name())
+    return free
+
+
+def collect_identifiers(source):
+    """
+    Returns the identifiers of the source that can be renamed, as a list of
+    {"name", "kind", "scope"}, and the collector holding the attribute and
+    parameter names.
+    """
+    tree, code = parse(source)
+    collector = identifier_collector()
+    collector.visit(tree)
+    # A name read where the selection does not bind it refers to code
+    # outside of the selection, so none of its occurrences is renamed
+    collector.protected.update(free_names(code))
+
+    builtin_names = set(dir(builtins))
+    # Renaming an attribute that is also read from outside objects would
+    # break either its definition or the outside accesses
+    foreign = collector.attributes & collector.foreign_attributes()
+
+    def renamable(name):
+        return not (name.startswith("__") and name.endswith("__")) and \
+            name not in builtin_names and name not in RESERVED_NAMES and \
+            name not in collector.protected and name not in foreign
+
+    identifiers = [identifier for identifier in collector.identifiers.values()
+                   if renamable(identifier["name"])]
+    return identifiers, collector
+
+
+def suggest_names(identifiers):
+    """
+    Deterministic local naming scheme, replacing the words of a name with
+    related words and otherwise suffixing it.
+    """
+    def split(name):
+        if "_" in name or name.islower():
+            return [word for word in name.split("_")], "_"
+        return re.findall(r"[A-Z]+[a-z0-9]*|[a-z0-9]+", name), ""
+
+    def rename(name):
+        words, separator = split(name)
+        for position, word in enumerate(words):
+            synonym = SYNONYMS.get(word.lower())
+            if synonym is None:
+                continue
+            if word[:1].isupper():
+                synonym = synonym.capitalize()
+            words[position] = synonym
+            return separator.join(words)
+        return name + ("_alt" if separator or name.islower() else "Alt")
+
+    return OrderedDict((identifier["name"], rename(identifier["name"]))
+                       for identifier in identifiers)
+
+
+def source_names(source):
+    return set(token.string for token in generate_tokens(source)
+               if token.type == tokenize.NAME)
+
+
+def generate_tokens(source):
+    return tokenize.generate_tokens(io.StringIO(source).readline)
+
+
+def validate_mapping(mapping, identifiers, source):
+    """
+    Keeps the renames of known identifiers to valid, unique names that do
+    not collide with any other name of the source.
+    """
+    old_names = set(identifier["name"] for identifier in identifiers)
+    taken = source_names(source) - old_names
+    builtin_names = set(dir(builtins))
+
+    validated = OrderedDict()
+    for old_name, new_name in mapping.items():
+        if old_name not in old_names or old_name == new_name:
+            continue
+        if not isinstance(new_name, str) or not new_name.isidentifier() or \
+                keyword.iskeyword(new_name) or new_name in builtin_names or \
+                new_name in taken or new_name in validated.values():
+            logger.warning("Ignoring rename of %s to %s", old_name, new_name)
+            continue
+        validated[old_name] = new_name
+    return validated
+
+
+def rename_expression(expression, rename_name):
+    """
+    Renames the names of a replacement field expression, outside of its
+    string literals.
+    """
+    def rename_match(match):
+        if match.group(3) is None:
+            return match.group(0)
+        receiver = None
+        if match.group(2):
+            before = re.search(r"([A-Za-z_]\w*)\s*$",
+                               expression[:match.start()])
+            receiver = before.group(1) if before else ""
+        return match.group(2) + rename_name(match.group(3), receiver)
+    return re.sub(r"""('[^']*'|"[^"]*")|(\.?)\b([A-Za-z_]\w*)\b""",
+                  rename_match, expression)
+
+
+def rename_field(string, start, rename_name, renamed):
+    """
+    Renames the replacement field of an f-string whose brace is at start,
+    appends it to renamed and returns the position following it. The
+    conversion and the text of the format spec are kept, the fields nested
+    in the format spec are renamed.
+    """
+    position = start + 1
+    depth = 0
+    quote = None
+    while position < len(string):
+        char = string[position]
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif char in "([{":
+            depth += 1
+        elif char in ")]}" and depth:
+            depth -= 1
+        elif depth == 0 and (char in ":}" or (
+                char == "!" and string[position + 1:position + 2] != "=")):
+            break
+        position += 1
+    renamed.append("{" + rename_expression(string[start + 1:position],
+                                           rename_name))
+
+    if string[position:position + 1] == "!":
+        end = position
+        while end < len(string) and string[end] not in ":}":
+            end += 1
+        renamed.append(string[position:end])
+        position = end
+
+    if string[position:position + 1] == ":":
+        renamed.append(":")
+        position += 1
+        while position < len(string) and string[position] != "}":
+            if string[position] == "{":
+                position = rename_field(string, position, rename_name,
+                                        renamed)
+            else:
+                renamed.append(string[position])
+                position += 1
+
+    renamed.append(string[position:position + 1])
+    return position + 1
+
+
+def rename_fstring(string, rename_name):
+    """
+    Renames the names of the replacement fields of an f-string token, as
+    tokenized before Python 3.12.
+    """
+    renamed = []
+    position = 0
+    while position < len(string):
+        pair = string[position:position + 2]
+        if pair in ("{{", "}}"):
+            renamed.append(pair)
+            position += 2
+        elif string[position] == "{":
+            position = rename_field(string, position, rename_name, renamed)
+        else:
+            renamed.append(string[position])
+            position += 1
+    return "".join(renamed)
+
+
+def apply_renames(source, mapping, collector):
+    """
+    Renames identifiers in the token stream, leaving every other character
+    of the source untouched.
+
+    Attributes are only renamed when accessed on self, cls or a class of
+    the source, keyword arguments only in calls to a function or class of
+    the source having that parameter and import statements are left as is.
+    """
+    if not mapping:
+        return source
+
+    line_starts = [0]
+    for line in io.StringIO(source).readlines():
+        line_starts.append(line_starts[-1] + len(line))
+
+    def rename_name(name, receiver=None):
+        if name not in mapping:
+            return name
+        if receiver is not None and (name not in collector.attributes or
+                                     not collector.owns(receiver)):
+            return name
+        return mapping[name]
+
+    tokens = list(generate_tokens(source))
+
+    def receiver_of(position):
+        """
+        Returns the name before the dot preceding the token at position,
+        an empty string when it is not a plain name, or None without dot.
+        """
+        if position < 2 or tokens[position - 1].string != ".":
+            return None
+        receiver = tokens[position - 2]
+        if receiver.type != tokenize.NAME or (
+                position > 2 and tokens[position - 3].string == "."):
+            return ""
+        return receiver.string
+
+    def callee_of(position):
+        """
+        Returns the function or class of the source called, or defined, by
+        the parenthesis at position, None for any other bracket.
+        """
+        if position < 1 or tokens[position - 1].type != tokenize.NAME:
+            return None
+        name = tokens[position - 1].string
+        receiver = receiver_of(position - 1)
+        if name not in collector.callables or keyword.iskeyword(name) or \
+                (receiver is not None and not collector.owns(receiver)):
+            return None
+        return name
+
+    replacements = []
+    callees = []
+    in_import = False
+    for position, token in enumerate(tokens):
+        previous = tokens[position - 1] if position else None
+        following = tokens[position + 1] if position + 1 < len(tokens) \
+            else None
+
+        if token.type in (tokenize.NEWLINE, tokenize.ENDMARKER):
+            in_import = False
+        elif token.type == tokenize.OP and token.string in ("(", "[", "{"):
+            callees.append(callee_of(position) if token.string == "("
+                           else None)
+        elif token.type == tokenize.OP and token.string in (")", "]", "}"):
+            if callees:
+                callees.pop()
+
+        new_string = token.string
+        if token.type == tokenize.NAME:
+            if token.string in ("import", "from") and \
+                    (previous is None or previous.type in (
+                        tokenize.NEWLINE, tokenize.NL, tokenize.INDENT,
+                        tokenize.DEDENT) or previous.string == ";"):
+                in_import = True
+            if in_import:
+                continue
+
+            is_keyword_argument = callees and following is not None and \
+                following.string == "=" and previous is not None and \
+                previous.string in ("(", ",")
+            if is_keyword_argument and (
+                    callees[-1] is None or token.string not in
+                    collector.callables[callees[-1]]):
+                continue
+            if previous is not None and previous.string == "!":
+                # Conversion of a replacement field, tokenized from 3.12
+                continue
+            new_string = rename_name(token.string, receiver_of(position))
+        elif token.type == tokenize.STRING and \
+                "f" in re.match(r"[A-Za-z]*", token.string).group(0).lower():
+            new_string = rename_fstring(token.string, rename_name)
+
+        if new_string != token.string:
+            start = line_starts[token.start[0] - 1] + token.start[1]
+            end = line_starts[token.end[0] - 1] + token.end[1]
+            replacements.append((start, end, new_string))
+
+    renamed = []
+    cursor = 0
+    for start, end, new_string in replacements:
+        renamed.append(source[cursor:start])
+        renamed.append(new_string)
+        cursor = end
+    renamed.append(source[cursor:])
+    return "".join(renamed)
+
+
+def request_mapping(config_handle, identifiers, ledger=None, notify=None):
+    """
+    Asks the model for the name mapping table only, instead of the whole
+    rewritten code.
+    """
+    table = "\n".join("{} ({} in {})".format(
+        identifier["name"], identifier["kind"], identifier["scope"])
+        for identifier in identifiers)
+
+    data = {
+        'messages': [{
+            'role': 'system',
+            'content': config_handle.get_persona(),
+        }, {
+            'role': 'user',
+            'content': config_handle.get("rename_prompt",
+                                         DEFAULT_RENAME_PROMPT) + table
+        }],
+        'model': config_handle.get_model(),
+        # The mapping repeats every name with its new name, it has its own
+        # limit as the section max_tokens is sized for code
+        'max_tokens': config_handle.get('rename_max_tokens',
+                                        estimate_tokens(table) * 4 + 50),
+        'temperature': config_handle.get('temperature', 0),
+        'top_p': config_handle.get('top_p', 1)
+    }
+
+    content, usage = request_completion(config_handle, data, ledger, notify)
+
+    try:
+        mapping = json.loads(content[content.index("{"):
+                                     content.rindex("}") + 1],
+                             object_pairs_hook=OrderedDict)
+    except ValueError:
+        logger.warning("Could not read the name mapping: %s", content)
+        return None
+    return mapping
+
+
+def rename_identifiers(config_handle, source, ledger=None, notify=None):
+    """
+    Renames the identifiers of Python source locally, using names from the
+    model when "rename_engine" is "model" or from the deterministic local
+    scheme when it is "local". Raises ValueError if the source is not
+    Python or the renamed code would not be valid Python.
+    """
+    identifiers, collector = collect_identifiers(source)
+    if not identifiers:
+        return source
+
+    mapping = None
+    if config_handle.get("rename_engine", None) == "model":
+        mapping = request_mapping(config_handle, identifiers, ledger, notify)
+    if mapping is None:
+        mapping = suggest_names(identifiers)
+
+    mapping = validate_mapping(mapping, identifiers, source)
+    logger.info("Renaming %s", json.dumps(mapping))
+    renamed = apply_renames(source, mapping, collector)
+
+    # Never hand back broken code, the caller falls back to a rewrite
+    try:
+        parse(renamed)
+    except ValueError as e:
+        raise ValueError("Renamed code is not valid Python: {}".format(e))
+    return renamed
@@ -0,0 +1,276 @@
+import os
+import re
+import math
+import time
+import threading
+from collections import Counter
+
+from .logs import logger
+from .paths import find_files, is_excluded, matches_globs
+from .prompt import estimate_tokens
+
+IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+SUBWORD = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+")
+
+STOPWORDS = set("""
+a an and are as at be by def class do else for from function if import in is
+it not of on or return self the this to var let const with while true false
+none null new public private static void int str
+""".split())
+
+
+def terms(text):
+    """
+    Splits a text into lowercase index terms: identifiers, and the words of
+    snake_case and CamelCase identifiers, which also covers the words of
+    docstrings and comments.
+    """
+    for word in IDENTIFIER.findall(text):
+        candidates = [word.strip("_")]
+        parts = SUBWORD.findall(word)
+        if len(parts) > 1:
+            candidates += parts
+        for candidate in candidates:
+            candidate = candidate.lower()
+            if len(candidate) > 1 and candidate not in STOPWORDS:
+                yield candidate
+
+
+def chunk(text, max_lines=60):
+    """
+    Splits a file into snippets starting at unindented lines that follow a
+    blank line, which approximates the top-level definitions of most
+    languages. Returns a list of (first line, text), lines counted from 1.
+    """
+    lines = text.splitlines(True)
+    snippets = []
+    start = 0
+    for number in range(1, len(lines) + 1):
+        at_end = number == len(lines)
+        boundary = not at_end and lines[number - 1].strip() == "" and \
+            lines[number][:1] not in ("", " ", "\t", "\n", "\r")
+        if at_end or boundary or number - start >= max_lines:
+            snippet = "".join(lines[start:number])
+            if snippet.strip():
+                snippets.append((start + 1, snippet))
+            start = number
+    return snippets
+
+
+class bm25_index():
+    """
+    An incrementally updatable BM25 inverted index of file snippets.
+
+    Methods
+    -------
+    update_file(path, text):
+
+        Replaces the snippets of a file.
+
+    remove_file(path):
+
+        Removes the snippets of a file.
+
+    search(query, top_k):
+
+        Returns the top_k snippets ranked by BM25 score.
+    """
+
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snippets = {}
+        self.lengths = {}
+        self.postings = {}
+        self.file_snippets = {}
+        self.total_length = 0
+        self.next_id = 0
+
+    def __remove__(self, path):
+        for snippet_id in self.file_snippets.pop(path, []):
+            for term in set(self.snippets[snippet_id]["terms"]):
+                postings = self.postings[term]
+                del postings[snippet_id]
+                if not postings:
+                    del self.postings[term]
+            self.total_length -= self.lengths.pop(snippet_id)
+            del self.snippets[snippet_id]
+
+    def remove_file(self, path):
+        with self.lock:
+            self.__remove__(path)
+
+    def update_file(self, path, text):
+        snippets = chunk(text)
+        with self.lock:
+            self.__remove__(path)
+            snippet_ids = []
+            for first_line, snippet in snippets:
+                term_counts = Counter(terms(snippet))
+                snippet_id = self.next_id
+                self.next_id += 1
+
+                self.snippets[snippet_id] = {
+                    "path": path, "line": first_line, "text": snippet,
+                    "end_line": first_line + snippet.count("\n"),
+                    "terms": term_counts}
+                self.lengths[snippet_id] = sum(term_counts.values())
+                self.total_length += self.lengths[snippet_id]
+                for term, count in term_counts.items():
+                    self.postings.setdefault(term, {})[snippet_id] = count
+                snippet_ids.append(snippet_id)
+            self.file_snippets[path] = snippet_ids
+
+    def search(self, query, top_k=5, skip=None):
+        """
+        Returns up to top_k snippets, as dictionaries with path, line,
+        end_line, text and score, excluding the snippets for which skip
+        returns True.
+        """
+        with self.lock:
+            count = len(self.snippets)
+            if not count:
+                return []
+            average_length = float(self.total_length) / count
+
+            scores = Counter()
+            for term in set(terms(query)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) /
+                               (len(postings) + 0.5))
+                for snippet_id, frequency in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b *
+                                      self.lengths[snippet_id] /
+                                      average_length)
+                    scores[snippet_id] += idf * frequency * (self.k1 + 1) / \
+                        (frequency + norm)
+
+            results = []
+            for snippet_id, score in scores.most_common():
+                snippet = self.snippets[snippet_id]
+                if skip is not None and skip(snippet):
+                    continue
+                result = dict((key, snippet[key]) for key in
+                              ("path", "line", "end_line", "text"))
+                result["score"] = score
+                results.append(result)
+                if len(results) >= top_k:
+                    break
+            return results
+
+
+class project_index():
+    """
+    BM25 index of the files of project folders, built in the background
+    and updated file by file.
+    """
+
+    def __init__(self, folders, include=("*",), exclude=(),
+                 max_file_bytes=256 * 1024):
+        self.folders = [os.path.abspath(folder) for folder in folders]
+        self.include = include
+        self.exclude = exclude
+        self.max_file_bytes = max_file_bytes
+
+        self.index = bm25_index()
+        self.ready = False
+        self.build_seconds = None
+
+    @property
+    def files(self):
+        """
+        The number of indexed files, kept up to date as files are saved.
+        """
+        return len(self.index.file_snippets)
+
+    def read(self, path):
+        try:
+            if os.path.getsize(path) > self.max_file_bytes:
+                return None
+            with open(path, "r", encoding="utf-8") as source_io:
+                return source_io.read()
+        except (IOError, OSError, UnicodeDecodeError):
+            return None
+
+    def build(self):
+        build_start = time.time()
+        for folder in self.folders:
+            for relpath in find_files(folder, self.include, self.exclude):
+                path = os.path.abspath(os.path.join(folder, relpath))
+                text = self.read(path)
+                if text is not None:
+                    self.index.update_file(path, text)
+
+        self.build_seconds = time.time() - build_start
+        self.ready = True
+        logger.info("Indexed %s files, %s snippets in %.2fs", self.files,
+                    len(self.index.snippets), self.build_seconds)
+
+    def contains(self, path):
+        """
+        Returns whether a file belongs to the indexed folders and globs.
+        """
+        path = os.path.abspath(path)
+        for folder in self.folders:
+            if not path.startswith(folder + os.sep):
+                continue
+            relpath = os.path.relpath(path, folder).replace(os.sep, "/")
+            return matches_globs(relpath, self.include) and \
+                not is_excluded(relpath, self.exclude)
+        return False
+
+    def update_path(self, path):
+        """
+        Updates the index after a file was saved or removed.
+        """
+        if not self.contains(path):
+            return
+        path = os.path.abspath(path)
+        text = self.read(path)
+        if text is None:
+            self.index.remove_file(path)
+        else:
+            self.index.update_file(path, text)
+
+    def search(self, query, top_k=5, path=None, lines=None):
+        """
+        Returns the top_k snippets relevant to the query and the query time,
+        skipping the snippets of path overlapping the (first, last) lines of
+        the query itself.
+        """
+        def overlaps(snippet):
+            return path is not None and lines is not None and \
+                snippet["path"] == os.path.abspath(path) and \
+                snippet["line"] <= lines[1] and snippet["end_line"] >= lines[0]
+
+        query_start = time.time()
+        results = self.index.search(query, top_k, overlaps)
+        query_seconds = time.time() - query_start
+        logger.info("Retrieved %s snippets in %.1fms", len(results),
+                    query_seconds * 1000)
+        return results, query_seconds
+
+
+def pack_context(results, budget_tokens):
+    """
+    Packs the snippets, most relevant first, into a prompt context within
+    the token budget.
+    """
+    parts = []
+    used = 0
+    for result in results:
+        part = "# {}:{}\n{}\n".format(result["path"], result["line"],
+                                      result["text"].rstrip("\n"))
+        cost = estimate_tokens(part)
+        if used + cost > budget_tokens:
+            continue
+        parts.append(part)
+        used += cost
+
+    if not parts:
+        return ""
+    return "Relevant code from the project:\n\n" + "\n".join(parts) + "\n"
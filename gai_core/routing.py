@@ -0,0 +1,124 @@
+import threading
+
+
+class alternate_router():
+    """
+    Keeps a rolling history of the latency and errors of each alternate and
+    chooses the alternate expected to answer a request the fastest.
+
+    Responses are not streamed, so the latency of a request covers both the
+    queueing and the generation of the answer. The history is an
+    exponentially weighted moving average (EWMA) of the seconds per
+    completion token and of the error rate.
+
+    Methods
+    -------
+    observe(name, latency, completion_tokens):
+
+        Records a successful response of an alternate.
+
+    observe_error(name):
+
+        Records a failed request of an alternate.
+
+    choose(candidates):
+
+        Chooses among candidate alternates given their request estimates.
+    """
+
+    alpha = 0.3
+    # Seconds per token assumed for alternates that never answered, when no
+    # other alternate did either
+    default_seconds_per_token = 0.05
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.history = {}
+
+    def __ewma__(self, previous, value):
+        if previous is None:
+            return value
+        return self.alpha * value + (1 - self.alpha) * previous
+
+    def __stats__(self, name):
+        return self.history.setdefault(name, {
+            "seconds_per_token": None, "errors": 0.0, "samples": 0})
+
+    def observe(self, name, latency, completion_tokens):
+        with self.lock:
+            stats = self.__stats__(name)
+            stats["seconds_per_token"] = self.__ewma__(
+                stats["seconds_per_token"],
+                latency / max(completion_tokens, 1))
+            stats["errors"] = self.__ewma__(stats["errors"], 0.0)
+            stats["samples"] += 1
+
+    def observe_error(self, name):
+        with self.lock:
+            stats = self.__stats__(name)
+            stats["errors"] = self.__ewma__(stats["errors"], 1.0)
+            stats["samples"] += 1
+
+    def estimate_seconds(self, name, output_tokens):
+        """
+        Estimates the duration of a request, penalised by the error rate.
+        Alternates that only failed so far are assumed as slow as the
+        slowest alternate that answered. Returns None when the alternate has
+        no history yet.
+        """
+        with self.lock:
+            stats = dict(self.__stats__(name))
+            rates = [other["seconds_per_token"]
+                     for other in self.history.values()
+                     if other["seconds_per_token"] is not None]
+
+        if not stats["samples"]:
+            return None
+
+        seconds_per_token = stats["seconds_per_token"]
+        if seconds_per_token is None:
+            seconds_per_token = max(rates) if rates else \
+                self.default_seconds_per_token
+
+        seconds = max(output_tokens, 1) * seconds_per_token
+        return seconds / max(1.0 - stats["errors"], 0.1)
+
+    def choose(self, candidates):
+        """
+        Chooses an alternate among candidates of the form
+        {name: {"input_tokens": N, "output_tokens": N, "context_tokens": N}}.
+
+        Candidates whose context is too small for the request are skipped,
+        unless none fits in which case the one with the largest context is
+        chosen. Candidates without history are tried first, otherwise the one
+        with the lowest estimated duration is chosen.
+
+        Returns a tuple (name, reason).
+        """
+        def fits(estimate):
+            context = estimate["context_tokens"]
+            return context is None or \
+                context >= estimate["input_tokens"] + estimate["output_tokens"]
+
+        fitting = sorted(name for name in candidates
+                         if fits(candidates[name]))
+        if not fitting:
+            name = max(candidates,
+                       key=lambda name: candidates[name]["context_tokens"])
+            return name, "largest context for ~{} tokens".format(
+                candidates[name]["input_tokens"])
+
+        estimates = {}
+        for name in fitting:
+            seconds = self.estimate_seconds(
+                name, candidates[name]["output_tokens"])
+            if seconds is None:
+                return name, "no history yet"
+            estimates[name] = seconds
+
+        name = min(fitting, key=lambda name: estimates[name])
+        return name, "est. {:.1f}s for ~{} tokens".format(
+            estimates[name], candidates[name]["input_tokens"])
+
+
+router = alternate_router()
@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import http.client
+
+from .balancer import balancer
+from .ledger import usage_ledger
+from .logs import logger
+from .prompt import estimate_tokens
+from .routing import router
+
+
+def get_ledger(config_handle, default_path=None):
+    """
+    Returns the usage ledger configured for a request, or None when the
+    ledger is disabled.
+    """
+    ledger_path = config_handle.get("usage_ledger", default_path)
+    if not ledger_path:
+        return None
+    return usage_ledger.for_path(ledger_path)
+
+
+def ledger_paths(configurations, section_names, default_path=None):
+    """
+    Returns the paths of every usage ledger the sections write to: the global
+    one and the ones set by a section or an alternate. Only the get method of
+    configurations is used, so that Sublime Text settings can be passed.
+    """
+    paths = []
+
+    def add(path):
+        if path:
+            path = os.path.abspath(os.path.expanduser(path))
+            if path not in paths:
+                paths.append(path)
+
+    add((configurations.get("oai", None) or {}).get("usage_ledger",
+                                                    default_path))
+
+    configs = [configurations.get(section_name, None) or {}
+               for section_name in section_names]
+    for config in [{"alternates": configurations.get("alternates", None)}] + \
+            configs:
+        add(config.get("usage_ledger", None))
+        for alternate in (config.get("alternates", None) or {}).values():
+            if isinstance(alternate, dict):
+                add(alternate.get("usage_ledger", None))
+    return paths
+
+
+def record_usage(config_handle, ledger, model, usage, latency):
+    cost = usage_ledger.price(config_handle.get("pricing", None),
+                              model, usage.get("prompt_tokens", 0),
+                              usage.get("completion_tokens", 0))
+    try:
+        ledger.record(config_handle.section_name,
+                      config_handle.alternate_name, model, usage,
+                      latency, cost)
+    except (IOError, OSError) as e:
+        logger.warning("Could not write usage ledger %s: %s",
+                       ledger.path, e)
+
+
+def request_completion(config_handle, request_data, ledger=None, notify=None):
+    """
+    Sends a chat completion request to the configured endpoint.
+
+    The daily budget is checked against the ledger before the request is
+    sent. When open_ai_base lists several bases the request is sent to the
+    one chosen by the balancer. The latency is reported to the router and
+    the usage is recorded in the ledger. Warnings are passed to notify, if
+    given.
+
+    Returns a tuple (content, usage).
+    """
+    log_level = config_handle.get("log_level", None)
+
+    if ledger is not None:
+        model = request_data.get("model")
+        pending_tokens = estimate_tokens(
+            json.dumps(request_data.get("messages", [])))
+        level, message = ledger.check_budget(
+            config_handle.get("budget", None), config_handle.section_name,
+            model, pending_tokens, usage_ledger.price(
+                config_handle.get("pricing", None), model, pending_tokens, 0))
+        if level is not None:
+            logger.warning(message)
+            if notify is not None:
+                notify(message)
+        if level == "hard":
+            raise ValueError(message)
+
+    # Several bases are balanced, each may override the endpoint and key
+    bases = config_handle.get("open_ai_base")
+    balancing = config_handle.get("balancing", None)
+    target = None
+    if isinstance(bases, list):
+        target = balancer.acquire(bases, balancing)
+        if log_level in ["requests", "all"]:
+            logger.info("Endpoint: %s", target["open_ai_base"])
+
+    def setting(key):
+        if target is not None and key in target:
+            return target[key]
+        return config_handle.get(key)
+
+    endpoint = setting("open_ai_endpoint")
+    apibase = setting("open_ai_base")
+    apikey = setting("open_ai_key")
+
+    connection = http.client.HTTPSConnection(
+        apibase, timeout=config_handle.get("max_seconds", 60))
+
+    headers = {
+        'api-key': apikey,
+        'Authorization': 'Bearer {}'.format(apikey),
+        'Content-Type': 'application/json'
+    }
+    data = json.dumps(request_data)
+
+    if log_level in ["requests", "all"]:
+        logger.info("Request Headers: %s", json.dumps(headers, indent=4))
+        logger.info("Request Data: %s", json.dumps(request_data, indent=4))
+
+    route_name = config_handle.alternate_name or "__default__"
+    if log_level in ["requests", "all"] and config_handle.routing_decision:
+        logger.info("Routed to %s", config_handle.routing_decision)
+
+    def release(failed):
+        if target is None:
+            return
+        balancer.release(target, time.time() - request_start, failed,
+                         balancing)
+        if log_level in ["requests", "all"]:
+            logger.info("Endpoint stats: %s",
+                        json.dumps(balancer.stats(), indent=4))
+
+    request_start = time.time()
+    try:
+        connection.request('POST', endpoint, body=data, headers=headers)
+        response = connection.getresponse()
+
+        if log_level in ["all"]:
+            logger.info("Response Status: %s", response.status)
+            logger.info("Response Headers: %s", json.dumps(dict(response.headers), indent=4))
+
+        response_dict = json.loads(response.read().decode())
+    except Exception:
+        router.observe_error(route_name)
+        release(True)
+        raise
+
+    if log_level in ["all"]:
+        logger.info("Response Data: %s", json.dumps(response_dict, indent=4))
+
+    if target is not None:
+        # Throttling and server errors count against the endpoint health
+        release(response.status == 429 or response.status >= 500)
+
+    if response_dict.get('error', None):
+        router.observe_error(route_name)
+        raise ValueError(response_dict['error'])
+
+    latency = time.time() - request_start
+    choice = response_dict.get('choices', [{}])[0]
+    ai_code = choice['message']['content']
+    usage = response_dict['usage']
+
+    router.observe(route_name, latency,
+                   usage.get('completion_tokens', estimate_tokens(ai_code)))
+
+    if ledger is not None:
+        record_usage(config_handle, ledger, request_data.get("model"), usage,
+                     latency)
+
+    return ai_code, usage
@@ -17,6 +17,7 @@ sys.modules['sublime'] = Mock(
 sys.modules['sublime_plugin'] = Mock()
 
 import GAI  # Replace with actual module name
+import gai_core
 
 
 class MockSettings:
@@ -171,6 +172,38 @@ class TestConfigurator:
 
             assert config.is_cancelled()
 
+    def test_configurator_routes_without_quick_panel(self):
+        """Test configurator selects an alternate when routing is enabled"""
+        source_config = {
+            "oai": {"model": "gpt-4", "routing": {"enabled": True}},
+            "alternates": {"fast": {"model": "gpt-4o-mini"}},
+            "command_edit": {}
+        }
+
+        base_obj = Mock()
+        with patch('gai_core.config.router', gai_core.alternate_router()) as router:
+            router.observe("__default__", 0.5, 100)
+            config = GAI.configurator(source_config, "command_edit", base_obj,
+                                      "x = 1")
+
+        base_obj.view.window().show_quick_panel.assert_not_called()
+        assert config.get_model() == "gpt-4o-mini"
+        assert config.routing_decision.startswith("fast")
+
+    def test_configurator_routing_without_candidates_asks(self):
+        """Test routing candidates naming no alternate fall back to the quick panel"""
+        source_config = {
+            "oai": {"model": "gpt-4", "routing": {"enabled": True, "candidates": ["fsat"]}},
+            "alternates": {"fast": {"model": "gpt-4o-mini"}},
+            "command_edit": {}
+        }
+
+        base_obj = Mock()
+        config = GAI.configurator(source_config, "command_edit", base_obj, "x = 1")
+
+        base_obj.view.window().show_quick_panel.assert_called_once()
+        assert config.routing_decision is None
+
 
 class TestBaseCodeGenerator:
 
@@ -226,9 +259,45 @@ class TestBaseCodeGenerator:
             assert "Refactor: optimize x = 1" in data['messages'][1]['content']
 
 
+class TestProjectIndexes:
+
+    def test_get_project_index_builds_once_in_background(self, tmp_path):
+        """Test the project index is built in the background and shared"""
+        (tmp_path / "helpers.py").write_text("def load_config(path):\n    return path\n")
+        retrieval = {"enabled": True, "include": ["*.py"]}
+
+        build_threads = []
+        thread_class = threading.Thread
+
+        def create_thread(*args, **kwargs):
+            thread = thread_class(*args, **kwargs)
+            build_threads.append(thread)
+            return thread
+
+        with patch.dict(GAI.project_indexes, clear=True):
+            with patch('threading.Thread', side_effect=create_thread):
+                index = GAI.get_project_index([str(tmp_path)], retrieval)
+            assert len(build_threads) == 1
+            build_threads[0].join(5)
+
+            with patch('threading.Thread', side_effect=create_thread):
+                assert GAI.get_project_index([str(tmp_path)], retrieval) is index
+            assert len(build_threads) == 1
+
+            # Other indexed files settings get their own index
+            with patch('threading.Thread', side_effect=create_thread):
+                other = GAI.get_project_index([str(tmp_path)], dict(retrieval, exclude=["helpers.py"]))
+            build_threads[1].join(5)
+            assert other is not index and other.files == 0
+
+        assert index.ready and index.files == 1
+        results, seconds = index.search("load_config", 5)
+        assert "def load_config(path):" in GAI.pack_context(results, 100)
+
+
 class TestAsyncCodeGenerator:
 
-    @patch('GAI.http.client.HTTPSConnection')
+    @patch('gai_core.transport.http.client.HTTPSConnection')
     def test_get_code_generator_response_success(self, mock_conn):
         """Test async thread successfully gets response"""
         mock_response = Mock()
@@ -267,7 +336,7 @@ class TestAsyncCodeGenerator:
         assert result == "print(x)"
         GAI.sublime.status_message.assert_called_with("Tokens used: 42")
 
-    @patch('GAI.http.client.HTTPSConnection')
+    @patch('gai_core.transport.http.client.HTTPSConnection')
     def test_get_code_generator_response_error(self, mock_conn):
         """Test error handling in API response"""
         mock_response = Mock()
@@ -293,6 +362,27 @@ class TestAsyncCodeGenerator:
         with pytest.raises(ValueError, match="Invalid API key"):
             thread.get_code_generator_response()
 
+    @patch('gai_core.transport.http.client.HTTPSConnection')
+    def test_hard_budget_blocks_request(self, mock_conn, tmp_path):
+        """Test a hard budget blocks the request before it is sent"""
+        ledger_path = str(tmp_path / "usage.jsonl")
+        gai_core.usage_ledger.for_path(ledger_path).record(
+            "command_edits", None, "gpt-4", {"total_tokens": 100}, 1.0)
+
+        config_handle = Mock(section_name="command_edits", alternate_name=None)
+        config_handle.get.side_effect = lambda k, d=None: {
+            "usage_ledger": ledger_path,
+            "budget": {"hard_tokens": 50}
+        }.get(k, d)
+
+        data_handle = Mock(return_value={"messages": [], "model": "gpt-4"})
+
+        thread = GAI.async_code_generator(Mock(), config_handle, data_handle)
+
+        with pytest.raises(ValueError, match="budget exceeded"):
+            thread.get_code_generator_response()
+        mock_conn.return_value.request.assert_not_called()
+
 
 # class TestReplaceTextCommand:
 
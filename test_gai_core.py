@@ -0,0 +1,738 @@
+import pytest
+from unittest.mock import Mock, patch
+import json
+import threading
+
+import gai_core
+from gai_core import batch, rename, retrieval
+from gai_core import patch as patch_module
+
+
+class TestAlternateRouter:
+
+    def test_choose_untried_alternate_first(self):
+        """Test alternates without history are explored first"""
+        router = gai_core.alternate_router()
+        router.observe("fast", 2.0, 100)
+        candidates = {
+            "fast": {"input_tokens": 10, "output_tokens": 10, "context_tokens": None},
+            "large": {"input_tokens": 10, "output_tokens": 10, "context_tokens": None}
+        }
+        assert router.choose(candidates)[0] == "large"
+
+    def test_choose_fastest_fitting_alternate(self):
+        """Test small requests go to fast alternates, large ones to large contexts"""
+        router = gai_core.alternate_router()
+        router.observe("fast", 2.0, 200)
+        router.observe("large", 8.0, 100)
+
+        small = {
+            "fast": {"input_tokens": 100, "output_tokens": 50, "context_tokens": 8000},
+            "large": {"input_tokens": 100, "output_tokens": 50, "context_tokens": 128000}
+        }
+        assert router.choose(small)[0] == "fast"
+
+        large = {
+            "fast": {"input_tokens": 20000, "output_tokens": 2000, "context_tokens": 8000},
+            "large": {"input_tokens": 20000, "output_tokens": 2000, "context_tokens": 128000}
+        }
+        assert router.choose(large)[0] == "large"
+
+    def test_errors_penalise_alternate(self):
+        """Test the error rate increases the estimated duration"""
+        router = gai_core.alternate_router()
+        router.observe("flaky", 2.0, 100)
+        before = router.estimate_seconds("flaky", 100)
+        router.observe_error("flaky")
+        assert router.estimate_seconds("flaky", 100) > before
+
+    def test_failing_alternate_is_not_explored_again(self):
+        """Test errors count as history so an alternate that never answered is avoided"""
+        router = gai_core.alternate_router()
+        for attempt in range(5):
+            router.observe_error("broken")
+        router.observe("ok", 2.0, 100)
+
+        candidates = {
+            "broken": {"input_tokens": 10, "output_tokens": 10, "context_tokens": None},
+            "ok": {"input_tokens": 10, "output_tokens": 10, "context_tokens": None}
+        }
+        assert router.choose(candidates)[0] == "ok"
+        assert router.estimate_seconds("broken", 10) > router.estimate_seconds("ok", 10)
+
+
+class TestUsageLedger:
+
+    def test_record_and_aggregate(self, tmp_path):
+        """Test ledger records usage and aggregates per section and model"""
+        ledger = gai_core.usage_ledger(str(tmp_path / "usage.jsonl"))
+        usage = {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}
+        ledger.record("command_edits", None, "gpt-4", usage, 0.5, 0.01)
+        ledger.record("command_edits", "fast", "gpt-3.5", usage, 0.25)
+        ledger.record("command_write", None, "gpt-4", dict(
+            usage, prompt_tokens_details={"cached_tokens": 8}), 1.0)
+
+        per_section = ledger.aggregate(("section",))
+        assert per_section[("command_edits",)]["total_tokens"] == 30
+        assert per_section[("command_write",)]["cache_hits"] == 1
+
+        per_model = ledger.aggregate(("model",))
+        assert per_model[("gpt-4",)]["requests"] == 2
+        assert per_model[("gpt-4",)]["cost"] == pytest.approx(0.01)
+
+        assert "command_write" in ledger.report()
+
+    def test_price(self):
+        """Test cost is computed per 1K tokens"""
+        pricing = {"gpt-4": {"prompt": 0.03, "completion": 0.06}}
+        assert gai_core.usage_ledger.price(pricing, "gpt-4", 1000, 500) == pytest.approx(0.06)
+        assert gai_core.usage_ledger.price(pricing, "unknown", 1000, 500) == 0
+
+    def test_check_budget(self, tmp_path):
+        """Test soft and hard budgets against today's usage"""
+        ledger = gai_core.usage_ledger(str(tmp_path / "usage.jsonl"))
+        ledger.record("command_edits", None, "gpt-4", {"total_tokens": 900}, 1.0)
+
+        budget = {"scope": "section", "soft_tokens": 500, "hard_tokens": 1000}
+        assert ledger.check_budget(budget, "command_write", "gpt-4", 50) == (None, None)
+        assert ledger.check_budget(budget, "command_edits", "gpt-4", 50)[0] == "soft"
+        assert ledger.check_budget(budget, "command_edits", "gpt-4", 200)[0] == "hard"
+
+        # Running totals are updated without re-reading the ledger
+        ledger.record("command_edits", None, "gpt-4", {"total_tokens": 200}, 1.0)
+        assert ledger.check_budget(budget, "command_edits", "gpt-4", 0)[0] == "hard"
+
+    def test_check_budget_cost_includes_pending_request(self, tmp_path):
+        """Test cost limits count the pending request and compare like token limits"""
+        ledger = gai_core.usage_ledger(str(tmp_path / "usage.jsonl"))
+        ledger.record("command_edits", None, "gpt-4", {"total_tokens": 100}, 1.0, 1.0)
+
+        budget = {"hard_tokens": 100, "hard_cost": 1.0}
+        assert ledger.check_budget(budget, "command_edits", "gpt-4") == (None, None)
+        assert ledger.check_budget(budget, "command_edits", "gpt-4", 0, 0.5)[0] == "hard"
+        assert ledger.check_budget(budget, "command_edits", "gpt-4", 1, 0.0)[0] == "hard"
+
+    def test_ledger_paths_of_sections_and_alternates(self, tmp_path):
+        """Test the report finds the ledgers set by sections and alternates"""
+        configurations = {
+            "oai": {},
+            "alternates": {"fast": {"usage_ledger": str(tmp_path / "fast.jsonl")}},
+            "command_edits": {"usage_ledger": str(tmp_path / "edits.jsonl"),
+                              "alternates": {"large": {"usage_ledger": ""}}},
+            "command_write": {"usage_ledger": str(tmp_path / "usage.jsonl")}
+        }
+
+        paths = gai_core.ledger_paths(configurations, ["command_edits", "command_write"],
+                                      str(tmp_path / "usage.jsonl"))
+        assert paths == [str(tmp_path / "usage.jsonl"), str(tmp_path / "fast.jsonl"),
+                         str(tmp_path / "edits.jsonl")]
+
+        configurations["oai"]["usage_ledger"] = ""
+        assert gai_core.ledger_paths(configurations, [])[0] == str(tmp_path / "fast.jsonl")
+
+
+class TestLoadSettings:
+
+    def test_comments_and_trailing_commas(self, tmp_path):
+        """Test settings with comments and trailing commas are parsed"""
+        settings = tmp_path / "gai.sublime-settings"
+        settings.write_text('''{
+    "oai": {
+        "open_ai_key": "<from https://beta.openai.com>", // key
+        /* "log_file": "", */
+        "max_seconds": 60,
+    },
+    "command_whiten": {"prompt": "Rename // keep",},
+}''')
+        user_settings = tmp_path / "user.sublime-settings"
+        user_settings.write_text('{"oai": {"max_seconds": 10}}')
+
+        configurations = gai_core.load_settings(str(settings), str(user_settings))
+
+        assert configurations["oai"] == {"max_seconds": 10}
+        assert configurations["command_whiten"]["prompt"] == "Rename // keep"
+
+        configurations = gai_core.load_settings(str(settings))
+        assert configurations["oai"]["open_ai_key"] == "<from https://beta.openai.com>"
+
+
+class TestBatch:
+
+    @pytest.fixture
+    def tree(self, tmp_path):
+        root = tmp_path / "src"
+        (root / "pkg").mkdir(parents=True)
+        (root / ".git").mkdir()
+        (root / "a.py").write_text("a = 1\n")
+        (root / "pkg" / "b.py").write_text("b = 2\n")
+        (root / "pkg" / "notes.txt").write_text("notes\n")
+        (root / ".git" / "c.py").write_text("c = 3\n")
+        return root
+
+    def test_find_files(self, tree):
+        """Test include and exclude globs, excluded directories are pruned"""
+        assert batch.find_files(str(tree), ["*.py"], [".git"]) == ["a.py", "pkg/b.py"]
+        assert batch.find_files(str(tree), ["pkg/*"], []) == ["pkg/b.py", "pkg/notes.txt"]
+
+    def test_run_batch_and_resume(self, tree, tmp_path):
+        """Test files are rewritten and a resumed run skips finished files"""
+        configurations = {"oai": {}, "command_whiten": {"keep_prompt_text": False}}
+        checkpoint_path = str(tmp_path / "checkpoint.json")
+
+        def fake_completion(config_handle, data, ledger=None, notify=None):
+            code = data["messages"][1]["content"].strip()
+            return code.upper(), {"total_tokens": 1}
+
+        with patch('gai_core.batch.request_completion', side_effect=fake_completion) as completion:
+            done, skipped, failed = batch.run_batch(
+                configurations, "command_whiten", str(tree), ["*.py"], [".git"],
+                jobs=2, checkpoint_path=checkpoint_path, report=Mock())
+
+            assert sorted(done) == ["a.py", "pkg/b.py"]
+            assert (tree / "a.py").read_text() == "A = 1"
+            assert completion.call_count == 2
+
+            done, skipped, failed = batch.run_batch(
+                configurations, "command_whiten", str(tree), ["*.py"], [".git"],
+                checkpoint_path=checkpoint_path, report=Mock())
+
+            assert done == [] and failed == []
+            assert sorted(skipped) == ["a.py", "pkg/b.py"]
+            assert completion.call_count == 2
+
+    def test_checkpoint_of_another_command_is_reset(self, tree, tmp_path):
+        """Test a checkpoint left by another command or instruction does not skip files"""
+        configurations = {"oai": {}, "command_write": {}, "command_edits": {}}
+        checkpoint_path = str(tmp_path / "checkpoint.json")
+
+        with patch('gai_core.batch.request_completion',
+                   return_value=("x = 1\n", {"total_tokens": 1})) as completion:
+            batch.run_batch(configurations, "command_write", str(tree), ["a.py"], [],
+                            checkpoint_path=checkpoint_path, report=Mock())
+            done, skipped, failed = batch.run_batch(
+                configurations, "command_edits", str(tree), ["a.py"], [],
+                checkpoint_path=checkpoint_path, instruction="Instruction: add docs",
+                report=Mock())
+            assert (done, skipped, failed) == (["a.py"], [], [])
+
+            done, skipped, failed = batch.run_batch(
+                configurations, "command_edits", str(tree), ["a.py"], [],
+                checkpoint_path=checkpoint_path, instruction="Instruction: add types",
+                report=Mock())
+            assert done == ["a.py"]
+            assert completion.call_count == 3
+
+    def test_run_batch_output_directory_and_failures(self, tree, tmp_path):
+        """Test results go to the output directory and failures are reported"""
+        output = tmp_path / "out"
+
+        def fake_completion(config_handle, data, ledger=None, notify=None):
+            if "b = 2" in data["messages"][1]["content"]:
+                raise ValueError("boom")
+            return "x", {"total_tokens": 1}
+
+        with patch('gai_core.batch.request_completion', side_effect=fake_completion):
+            done, skipped, failed = batch.run_batch(
+                {"oai": {}}, "command_edits", str(tree), ["*.py"], [".git"],
+                output=str(output), report=Mock())
+
+        assert done == ["a.py"] and failed == ["pkg/b.py"]
+        assert (output / "a.py").read_text() == "x"
+        assert (tree / "a.py").read_text() == "a = 1\n"
+
+    def test_rate_limiter_spaces_requests(self):
+        """Test the rate limiter spaces requests evenly"""
+        limiter = batch.rate_limiter(600)
+        with patch('gai_core.batch.time') as mock_time:
+            mock_time.time.return_value = 100.0
+            limiter.wait()
+            limiter.wait()
+            mock_time.sleep.assert_called_once_with(pytest.approx(0.1))
+
+
+class TestRename:
+
+    source = '''    import os
+
+    class UserManager(object):
+        """Keeps the users data."""
+
+        def __init__(self, data, count=0):
+            self.data = data  # data of the users
+            self.count = count
+
+        def get_value(self, key):
+            result = self.data.get(key)
+            return os.path.join(result, sep=key) + f"{self.count!r}{{key}}"
+
+    manager = UserManager(data={}, count=1)
+'''
+
+    def test_collect_identifiers(self):
+        """Test bound identifiers are collected, imports and builtins are not"""
+        identifiers, collector = rename.collect_identifiers(self.source)
+        names = dict((identifier["name"], identifier) for identifier in identifiers)
+
+        assert set(names) == {"UserManager", "data", "count", "get_value",
+                              "key", "result", "manager"}
+        assert names["key"]["scope"] == "UserManager.get_value"
+        assert "get_value" in collector.attributes
+        assert "os" in collector.protected
+
+    def test_apply_renames_is_exact_apart_from_names(self):
+        """Test only identifier tokens change, keyword arguments of external calls do not"""
+        identifiers, collector = rename.collect_identifiers(self.source)
+        mapping = {"data": "payload", "key": "identifier", "count": "total",
+                   "get_value": "fetch_value"}
+
+        renamed = rename.apply_renames(self.source, mapping, collector)
+
+        assert 'self.payload = payload  # data of the users' in renamed
+        assert 'def fetch_value(self, identifier):' in renamed
+        assert 'sep=identifier) + f"{self.total!r}{{key}}"' in renamed
+        assert 'UserManager(payload={}, total=1)' in renamed
+        assert '"""Keeps the users data."""' in renamed
+        assert len(renamed.splitlines()) == len(self.source.splitlines())
+
+    def test_apply_renames_keeps_keywords_of_outside_calls(self):
+        """Test keyword arguments of builtin calls are kept even when they name a parameter"""
+        source = "def order(items, key):\n    return sorted(items, key=key)\n"
+        identifiers, collector = rename.collect_identifiers(source)
+
+        renamed = rename.apply_renames(source, {"items": "elements", "key": "ident"},
+                                       collector)
+
+        assert renamed == "def order(elements, ident):\n    return sorted(elements, key=ident)\n"
+
+    def test_apply_renames_keeps_attributes_of_outside_objects(self):
+        """Test attributes read from outside objects are never renamed"""
+        source = ("class Client(object):\n"
+                  "    def load(self, resp):\n"
+                  "        self.data = resp.data\n"
+                  "        self.body = resp.text\n"
+                  "        return Client.load, self.body\n")
+        identifiers, collector = rename.collect_identifiers(source)
+        names = [identifier["name"] for identifier in identifiers]
+
+        assert "data" not in names
+        assert "body" in names
+
+        mapping = {"data": "payload", "body": "content", "load": "fetch"}
+        renamed = rename.apply_renames(source, mapping, collector)
+        assert "self.payload = resp.data" in renamed
+        assert "self.content = resp.text" in renamed
+        assert "return Client.fetch, self.content" in renamed
+
+    def test_names_bound_outside_the_selection_are_kept(self):
+        """Test a name read where the selection does not bind it is never renamed"""
+        source = "def f():\n    data = 1\n    return data\n\ndef g():\n    return data\n"
+        identifiers, collector = rename.collect_identifiers(source)
+        names = [identifier["name"] for identifier in identifiers]
+
+        assert "data" not in names
+        assert "f" in names and "g" in names
+
+        # Globals of the selection and closures are resolved to the selection
+        source = "data = 1\n\ndef f(items):\n    def g():\n        return items\n    return data\n"
+        names = [identifier["name"] for identifier in rename.collect_identifiers(source)[0]]
+        assert {"data", "items", "g"} <= set(names)
+
+    def test_fstring_conversion_and_format_spec_are_kept(self):
+        """Test only the expressions of replacement fields are renamed"""
+        source = ('def f(x, r, width):\n'
+                  '    return f"{x!r} {x:>{width}} {r:r>3} {x[\'r\']}"\n')
+        identifiers, collector = rename.collect_identifiers(source)
+        mapping = {"x": "value", "r": "rate", "width": "size"}
+
+        renamed = rename.apply_renames(source, mapping, collector)
+
+        assert 'f"{value!r} {value:>{size}} {rate:r>3} {value[\'r\']}"' in renamed
+
+    def test_rename_identifiers_rejects_invalid_result(self):
+        """Test a rename producing invalid Python raises ValueError so callers fall back"""
+        config_handle = Mock()
+        config_handle.get.side_effect = lambda k, d=None: {"rename_engine": "local"}.get(k, d)
+
+        with patch('gai_core.rename.apply_renames', return_value="def (:\n"):
+            with pytest.raises(ValueError, match="not valid Python"):
+                rename.rename_identifiers(config_handle, "count = 1\n")
+
+    def test_validate_mapping(self):
+        """Test invalid, colliding and unknown renames are dropped"""
+        identifiers, collector = rename.collect_identifiers(self.source)
+        mapping = rename.validate_mapping(
+            {"data": "os", "key": "class", "count": "total", "result": "total",
+             "unknown": "other", "manager": "the_manager"},
+            identifiers, self.source)
+
+        assert mapping == {"count": "total", "manager": "the_manager"}
+
+    def test_rename_identifiers_with_model_mapping(self):
+        """Test the model is only asked for the mapping table"""
+        config_handle = Mock()
+        config_handle.get.side_effect = lambda k, d=None: {
+            "rename_engine": "model", "max_tokens": 20}.get(k, d)
+
+        answer = '```json\n{"result": "outcome", "manager": "handler"}\n```'
+        with patch('gai_core.rename.request_completion',
+                   return_value=(answer, {"total_tokens": 1})) as completion:
+            renamed = rename.rename_identifiers(config_handle, self.source)
+
+        data = completion.call_args[0][1]
+        assert "result (variable in UserManager.get_value)" in data["messages"][1]["content"]
+        # The mapping is not truncated by the max_tokens sized for code
+        assert data["max_tokens"] > 20
+        assert renamed == self.source.replace("result", "outcome").replace(
+            "manager = ", "handler = ")
+
+    def test_rename_identifiers_locally(self):
+        """Test the local scheme renames without any request"""
+        config_handle = Mock()
+        config_handle.get.side_effect = lambda k, d=None: {
+            "rename_engine": "local"}.get(k, d)
+
+        with patch('gai_core.rename.request_completion') as completion:
+            renamed = rename.rename_identifiers(config_handle, self.source)
+
+        completion.assert_not_called()
+        assert "class AccountManager(object):" in renamed
+        assert "self.payload = payload" in renamed
+
+    def test_rename_rejects_other_languages(self):
+        """Test non Python code raises ValueError so callers fall back"""
+        with pytest.raises(ValueError):
+            rename.collect_identifiers("function f(a) { return a; }")
+
+    def test_process_text_falls_back_to_rewrite(self):
+        """Test batch processing renames Python locally and rewrites the rest"""
+        configurations = {"oai": {}, "command_whiten": {"rename_engine": "local"}}
+
+        with patch('gai_core.batch.request_completion',
+                   return_value=("rewritten", {"total_tokens": 1})) as completion:
+            assert batch.process_text(configurations, "command_whiten", "count = 1\n",
+                                      python_source=True) == "total = 1\n"
+            completion.assert_not_called()
+
+            assert batch.process_text(configurations, "command_whiten", "let count = 1;",
+                                      python_source=True) == "rewritten"
+
+    def test_process_text_renames_for_whiten_only(self):
+        """Test a rename_engine set for every section does not affect other commands"""
+        configurations = {"oai": {"rename_engine": "local"}, "command_edits": {}}
+
+        with patch('gai_core.batch.request_completion',
+                   return_value=("rewritten", {"total_tokens": 1})) as completion:
+            assert batch.process_text(configurations, "command_edits", "count = 1\n",
+                                      "Instruction: add a comment",
+                                      python_source=True) == "rewritten"
+            completion.assert_called_once()
+
+    def test_process_text_patches_for_edits_only(self):
+        """Test an edit_format set for every section only applies to command_edits"""
+        configurations = {"oai": {"edit_format": "diff"},
+                          "command_completions": {"keep_prompt_text": True}}
+
+        with patch('gai_core.batch.request_edit') as request_edit, \
+                patch('gai_core.batch.request_completion',
+                      return_value=(" + 1", {"total_tokens": 1})):
+            assert batch.process_text(configurations, "command_completions",
+                                      "x = 1") == "x = 1 + 1"
+            request_edit.assert_not_called()
+
+
+class TestEndpointBalancer:
+
+    endpoints = ["east.example.com", {"open_ai_base": "west.example.com", "open_ai_key": "k"}]
+
+    def test_least_outstanding(self):
+        """Test requests are spread over the endpoints with the least outstanding requests"""
+        balancer = gai_core.endpoint_balancer()
+        first = balancer.acquire(self.endpoints)
+        second = balancer.acquire(self.endpoints)
+
+        assert first == {"open_ai_base": "east.example.com"}
+        assert second["open_ai_key"] == "k"
+
+        balancer.release(first, 0.5)
+        assert balancer.acquire(self.endpoints) == first
+
+    def test_lowest_latency(self):
+        """Test the latency strategy picks the fastest endpoint"""
+        balancer = gai_core.endpoint_balancer()
+        balancing = {"strategy": "latency"}
+        balancer.release(balancer.acquire(self.endpoints, balancing), 2.0, False, balancing)
+        balancer.release(balancer.acquire(self.endpoints, balancing), 0.5, False, balancing)
+
+        assert balancer.acquire(self.endpoints, balancing)["open_ai_base"] == "west.example.com"
+
+    def test_circuit_breaker(self):
+        """Test the circuit opens on repeated failures and is probed after the reset delay"""
+        balancer = gai_core.endpoint_balancer()
+        balancing = {"failure_threshold": 2, "reset_seconds": 30}
+        east = {"open_ai_base": "east.example.com"}
+
+        with patch('gai_core.balancer.time') as mock_time:
+            mock_time.time.return_value = 100.0
+            for _ in range(2):
+                balancer.acquire([east], balancing)
+                balancer.release(east, None, True, balancing)
+
+            assert balancer.stats()["east.example.com"]["state"] == "open"
+            with pytest.raises(ValueError, match="unavailable"):
+                balancer.acquire([east], balancing)
+
+            mock_time.time.return_value = 131.0
+            assert balancer.acquire([east], balancing) == east
+            assert balancer.stats()["east.example.com"]["state"] == "half_open"
+            with pytest.raises(ValueError):
+                balancer.acquire([east], balancing)
+
+            balancer.release(east, 0.4, False, balancing)
+            assert balancer.stats()["east.example.com"]["state"] == "closed"
+
+    @patch('gai_core.transport.http.client.HTTPSConnection')
+    def test_request_uses_balanced_endpoint(self, mock_conn):
+        """Test the transport sends to the endpoint chosen and records failures"""
+        mock_response = Mock(status=503)
+        mock_response.read.return_value = json.dumps({"error": {"message": "busy"}}).encode()
+        mock_conn.return_value.getresponse.return_value = mock_response
+
+        config_handle = Mock(alternate_name=None, routing_decision=None)
+        config_handle.get.side_effect = lambda k, d=None: {
+            "open_ai_base": self.endpoints,
+            "open_ai_endpoint": "/chat",
+            "open_ai_key": "default"
+        }.get(k, d)
+
+        balancer = gai_core.endpoint_balancer()
+        with patch('gai_core.transport.balancer', balancer):
+            with pytest.raises(ValueError, match="busy"):
+                gai_core.request_completion(config_handle, {"messages": []})
+
+        mock_conn.assert_called_once_with("east.example.com", timeout=60)
+        headers = mock_conn.return_value.request.call_args[1]["headers"]
+        assert headers["api-key"] == "default"
+        stats = balancer.stats()["east.example.com"]
+        assert stats["failures"] == 1 and stats["outstanding"] == 0
+
+
+class TestRetrieval:
+
+    def test_terms_split_identifiers(self):
+        """Test identifiers are indexed whole and by their words"""
+        assert list(retrieval.terms("def parseHttpHeader(raw_value):")) == [
+            "parsehttpheader", "parse", "http", "header", "raw_value", "raw", "value"]
+
+    def test_chunk_top_level_blocks(self):
+        """Test files are split at unindented lines following a blank line"""
+        text = "import os\n\ndef a():\n    return 1\n\n    # still a\n\nclass B:\n    pass\n"
+        assert [line for line, snippet in retrieval.chunk(text)] == [1, 3, 8]
+        assert len(retrieval.chunk("x = 1\n" * 130, max_lines=60)) == 3
+
+    def test_bm25_ranking_and_incremental_updates(self):
+        """Test the most relevant snippet ranks first and updates replace snippets"""
+        index = retrieval.bm25_index()
+        index.update_file("users.py", "def load_user(user_id):\n    return db.fetch_user(user_id)\n")
+        index.update_file("orders.py", "def load_order(order_id):\n    return db.fetch_order(order_id)\n")
+        index.update_file("misc.py", "def helper():\n    return 1\n")
+
+        results = index.search("user = load_user(42)", top_k=2)
+        assert results[0]["path"] == "users.py"
+
+        index.update_file("users.py", "def unrelated():\n    pass\n")
+        assert all(result["path"] != "users.py"
+                   for result in index.search("load_user user"))
+
+        index.remove_file("orders.py")
+        assert index.search("order") == []
+        assert set(index.file_snippets) == {"users.py", "misc.py"}
+
+    def test_project_index_build_update_and_search(self, tmp_path):
+        """Test the project index skips the selection itself and follows saved files"""
+        (tmp_path / ".git").mkdir()
+        (tmp_path / ".git" / "config").write_text("load_config\n")
+        helpers = tmp_path / "helpers.py"
+        helpers.write_text("def load_config(path):\n    return read(path)\n")
+        main = tmp_path / "main.py"
+        main.write_text("config = load_config('a')\n")
+
+        index = retrieval.project_index([str(tmp_path)], ["*.py"], [".git"])
+        index.build()
+        assert index.ready and index.files == 2
+
+        results, seconds = index.search("load_config", 5, str(main), (1, 1))
+        assert [result["path"] for result in results] == [str(helpers)]
+
+        helpers.write_text("def save_config(path):\n    pass\n")
+        index.update_path(str(helpers))
+        results, seconds = index.search("save_config", 5)
+        assert results[0]["text"].startswith("def save_config")
+
+        (tmp_path / "extra.py").write_text("def extra():\n    pass\n")
+        index.update_path(str(tmp_path / "extra.py"))
+        assert index.files == 3
+        main.unlink()
+        index.update_path(str(main))
+        assert index.files == 2
+
+        assert not index.contains(str(tmp_path / ".git" / "config"))
+
+    def test_project_index_excludes_nested_directories(self, tmp_path):
+        """Test saved files below an excluded directory are not indexed"""
+        index = retrieval.project_index([str(tmp_path)], ["*"], ["node_modules"])
+
+        assert not index.contains(str(tmp_path / "node_modules" / "x" / "y.js"))
+        assert not index.contains(str(tmp_path / "app" / "node_modules" / "y.js"))
+        assert index.contains(str(tmp_path / "app" / "y.js"))
+
+    def test_pack_context_budget(self):
+        """Test snippets are packed in order until the token budget is used"""
+        results = [{"path": "a.py", "line": 1, "text": "x" * 400},
+                   {"path": "b.py", "line": 3, "text": "y = 1\n"}]
+
+        context = retrieval.pack_context(results, 50)
+        assert "# b.py:3\ny = 1" in context and "a.py" not in context
+        assert retrieval.pack_context(results, 1) == ""
+
+
+class TestPatch:
+
+    source = "def add(a, b):\n    return a + b\n\n\ndef sub(a, b):\n    return a - b\n"
+
+    def test_apply_unified_diff(self):
+        """Test hunks apply at their line, or the closest matching position"""
+        diff = '''```diff
+--- a
++++ b
+@@ -1,2 +1,3 @@
+ def add(a, b):
++    """Add two numbers."""
+     return a + b
+@@ -9,2 +10,2 @@
+ def sub(a, b):
+-    return a - b
++    return a - b  # difference
+```'''
+        patched = patch_module.apply_unified_diff(self.source, diff)
+        assert patched == self.source.replace(
+            "return a + b", '"""Add two numbers."""\n    return a + b').replace(
+            "return a - b", "return a - b  # difference")
+
+    def test_unified_diff_keeps_lines_starting_with_header_prefixes(self):
+        """Test added and removed lines starting with ++ or -- are not taken as file headers"""
+        source = "i = 0\n--j;\nprint(i)\n"
+        diff = "--- a\n+++ b\n@@ -1,3 +1,3 @@\n i = 0\n---j;\n+++i;\n print(i)\n"
+
+        assert patch_module.apply_unified_diff(source, diff) == "i = 0\n++i;\nprint(i)\n"
+
+    def test_unified_diff_not_applying(self):
+        """Test a diff whose context is not in the code raises ValueError"""
+        with pytest.raises(ValueError):
+            patch_module.apply_unified_diff(self.source, "@@ -1,1 +1,1 @@\n-def mul(a, b):\n+def div(a, b):\n")
+        with pytest.raises(ValueError):
+            patch_module.apply_unified_diff(self.source, "Here is the code: ...")
+
+    def test_apply_search_replace(self):
+        """Test search/replace blocks apply when found exactly once"""
+        blocks = "<<<<<<< SEARCH\ndef sub(a, b):\n=======\ndef subtract(a, b):\n>>>>>>> REPLACE\n"
+        assert patch_module.apply_search_replace(self.source, blocks) == \
+            self.source.replace("def sub(", "def subtract(")
+
+        ambiguous = "<<<<<<< SEARCH\n(a, b):\n=======\n(x, y):\n>>>>>>> REPLACE"
+        with pytest.raises(ValueError, match="2 times"):
+            patch_module.apply_search_replace(self.source, ambiguous)
+
+    def test_request_edit_falls_back_to_full_rewrite(self):
+        """Test a patch that does not apply triggers the full rewrite request"""
+        answers = [("<<<<<<< SEARCH\nmissing\n=======\nx\n>>>>>>> REPLACE", {"total_tokens": 1}),
+                   ("rewritten", {"total_tokens": 2})]
+        notify = Mock()
+
+        with patch('gai_core.patch.request_completion', side_effect=answers) as completion:
+            result = patch_module.request_edit(Mock(), {"patch": True}, {"patch": False},
+                                               self.source, "search_replace", notify=notify)
+
+        assert result == ("rewritten", {"total_tokens": 2})
+        assert completion.call_args_list[1][0][1] == {"patch": False}
+        notify.assert_called_once()
+
+    def test_build_request_asks_for_patch(self):
+        """Test the edit format instructions are added to the prompt"""
+        config_handle = Mock()
+        config_handle.get_prompt.return_value = ""
+        config_handle.get.side_effect = lambda k, d=None: d
+
+        data, text = gai_core.build_request(config_handle, "x = 1", "Instruction: rename",
+                                            edit_format="diff")
+        assert "unified diff" in data["messages"][1]["content"]
+
+        with pytest.raises(ValueError):
+            gai_core.build_request(config_handle, "x = 1", edit_format="xml")
+
+
+class TestRequestProfiler:
+
+    def run_nested_stages(self, profiler):
+        """Runs a worker stage while the UI stage is profiled, as the plugin does"""
+        def ui_stage():
+            worker = threading.Thread(target=lambda: profiler.profile(
+                "Worker thread", lambda: [0] * 100000))
+            worker.start()
+            worker.join()
+            return 3
+
+        profiler.start()
+        assert profiler.profile("UI thread", ui_stage) == 3
+        profiler.stop()
+        return profiler.report()
+
+    def test_profile_nested_stages_across_threads(self):
+        """Test every stage is reported and profiled while another one is profiled"""
+        report = self.run_nested_stages(gai_core.request_profiler())
+
+        assert "== UI thread (MainThread) - " in report
+        assert "== Worker thread (" in report
+        assert "cumulative" in report
+        assert "Not fully profiled" not in report
+        assert "peak:" in report
+        assert "Top allocation sites:" in report
+
+    def test_profile_runs_stages_when_profiler_is_busy(self):
+        """Test stages still run when another profiling tool is active"""
+        busy_profile = Mock()
+        busy_profile.enable.side_effect = ValueError("Another profiling tool is already active")
+
+        with patch('gai_core.profiling.cProfile.Profile', return_value=busy_profile):
+            report = self.run_nested_stages(gai_core.request_profiler())
+
+        assert "Not fully profiled, another profiling tool was active" in report
+        assert "== Worker thread (" in report
+        busy_profile.disable.assert_not_called()
+
+    def test_stop_keeps_tracing_started_elsewhere(self):
+        """Test a tracemalloc session started before the profiler keeps running"""
+        tracemalloc = pytest.importorskip("tracemalloc")
+        tracemalloc.start()
+        try:
+            report = self.run_nested_stages(gai_core.request_profiler())
+            assert tracemalloc.is_tracing()
+            assert "peak:" in report
+        finally:
+            tracemalloc.stop()
+
+        self.run_nested_stages(gai_core.request_profiler())
+        assert not tracemalloc.is_tracing()
+
+    def test_profile_reraises_and_keeps_stage(self):
+        """Test a failing stage is still part of the report"""
+        profiler = gai_core.request_profiler()
+        profiler.start()
+
+        def fail():
+            raise ValueError("failed")
+
+        with pytest.raises(ValueError):
+            profiler.profile("Failing stage", fail)
+        profiler.stop()
+
+        assert "== Failing stage" in profiler.report()